@@ -0,0 +1,133 @@
+# analytics.py
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import streaks
+from storage import ALL_COMPLETIONS, get_connection
+from utils import PERIODICITIES
+
+
+def load_frames(conn=None):
+    """
+    Loads habits and all completions once into columnar frames.
+    Completions come back sorted by habit and time, with a parsed timestamp;
+    a compacted day is one row whose count holds the day's completions.
+    """
+    conn = conn or get_connection()
+    habits = pd.DataFrame(
+        conn.execute("SELECT id, name, periodicity, created_at, version FROM habits ORDER BY id").fetchall(),
+        columns=["id", "name", "periodicity", "created_at", "version"],
+    )
+    completions = pd.DataFrame(
+        conn.execute(f"SELECT habit_id, completed_at, count FROM ({ALL_COMPLETIONS}) ORDER BY habit_id, completed_at").fetchall(),
+        columns=["habit_id", "completed_at", "count"],
+    )
+    completions["ts"] = pd.to_datetime(completions["completed_at"], format="ISO8601")
+    return habits, completions
+
+
+def _period_index(days, periodicity):
+    """
+    Maps datetime64[D] values to a running period number for their periodicity,
+    the vectorized equivalent of streaks.bucketing_for(periodicity).ordinal.
+    """
+    days = days.astype("datetime64[D]")
+    ordinal = days.astype(np.int64)
+    index = np.select(
+        [periodicity == "weekly", periodicity == "monthly", periodicity == "yearly"],
+        [
+            (ordinal + 3) // 7,  # 1970-01-01 was a Thursday; weeks start on Monday
+            days.astype("datetime64[M]").astype(np.int64),
+            days.astype("datetime64[Y]").astype(np.int64),
+        ],
+        default=ordinal,
+    )
+    custom = ~np.isin(periodicity, PERIODICITIES)
+    if custom.any():
+        index[custom] = [streaks.bucketing_for(p).ordinal(d.item()) for p, d in zip(periodicity[custom], days[custom])]
+    return index
+
+
+def _run_lengths(habit_ids, steps):
+    """Length of the consecutive run each period belongs to, up to and including it."""
+    same_habit = habit_ids == np.roll(habit_ids, 1)
+    same_habit[:1] = False
+    run_id = np.cumsum(~(same_habit & (steps == 1)))
+    return pd.Series(run_id).groupby(run_id).cumcount().to_numpy() + 1
+
+
+def habit_stats(habits, completions, today=None):
+    """
+    Per-habit statistics, computed with vectorized diff/cumsum grouping:
+    completions, current_streak, longest_streak and completion_rate
+    (share of periods since creation with at least one completion).
+    """
+    today = np.datetime64(today or datetime.now().date(), "D")
+    stats = habits.set_index("id")[["name", "periodicity", "version"]].copy()
+    stats["completions"] = 0
+    stats["current_streak"] = 0
+    stats["longest_streak"] = 0
+    stats["completion_rate"] = 0.0
+
+    c = completions[completions["habit_id"].isin(stats.index)]
+    if not c.empty:
+        habit_ids = c["habit_id"].to_numpy()
+        periodicity = stats["periodicity"].reindex(habit_ids).to_numpy()
+        # one row per habit and period; completions are sorted, so periods ascend per habit
+        periods = pd.DataFrame({
+            "habit_id": habit_ids,
+            "periodicity": periodicity,
+            "period": _period_index(c["ts"].to_numpy(), periodicity),
+        }).drop_duplicates(["habit_id", "period"])
+        period = periods["period"].to_numpy()
+        periods["run"] = _run_lengths(periods["habit_id"].to_numpy(), np.diff(period, prepend=period[:1]))
+        periods["gap"] = _period_index(np.full(len(periods), today), periods["periodicity"].to_numpy()) - period
+
+        by_habit = periods.groupby("habit_id", sort=False)
+        last = by_habit.last()
+        # the current period is not over yet, so a run ending in the previous one is still alive
+        stats.loc[last.index, "current_streak"] = last["run"].where(last["gap"] <= 1, 0)
+        stats.loc[last.index, "longest_streak"] = by_habit["run"].max()
+        stats.loc[last.index, "completions"] = c.groupby("habit_id", sort=False)["count"].sum()
+
+        created = pd.to_datetime(habits.set_index("id")["created_at"], format="ISO8601").to_numpy().astype("datetime64[D]")
+        periods_active = _period_index(np.full(len(stats), today), stats["periodicity"].to_numpy()) \
+            - _period_index(created, stats["periodicity"].to_numpy()) + 1
+        periods_done = by_habit.size().reindex(stats.index, fill_value=0).to_numpy()
+        stats["completion_rate"] = np.clip(periods_done / np.maximum(periods_active, 1), 0, 1)
+
+    return stats
+
+
+def periodicity_summary(stats):
+    """Aggregates per periodicity: habit count, completions, mean rate and best streak."""
+    summary = stats.groupby("periodicity").agg(
+        habits=("name", "size"),
+        completions=("completions", "sum"),
+        completion_rate=("completion_rate", "mean"),
+        longest_streak=("longest_streak", "max"),
+    )
+    summary = summary.reindex(PERIODICITIES)
+    summary = summary.fillna({"habits": 0, "completions": 0, "completion_rate": 0.0, "longest_streak": 0})
+    return summary.astype({"habits": int, "completions": int, "longest_streak": int})
+
+
+def build_report(conn=None, today=None):
+    """Everything the /analysis page shows, from a single load of the data."""
+    habits, completions = load_frames(conn)
+    stats = habit_stats(habits, completions, today)
+    summary = periodicity_summary(stats)
+
+    longest_habit, longest_streak = None, 0
+    if not stats.empty and stats["longest_streak"].max() > 0:
+        best = stats["longest_streak"].idxmax()  # first (lowest id) habit on ties
+        longest_habit, longest_streak = stats.at[best, "name"], int(stats.at[best, "longest_streak"])
+
+    return {
+        "habits": stats.reset_index().to_dict("records"),
+        "by_periodicity": summary.reset_index().to_dict("records"),
+        "longest_habit": longest_habit,
+        "longest_streak": longest_streak,
+    }
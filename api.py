@@ -0,0 +1,201 @@
+# api.py
+import io
+from datetime import date, timedelta
+
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from werkzeug.local import LocalProxy
+
+import storage
+import transfer
+from habit import Habit
+from tenancy import current_manager
+from utils import PERIODICITIES, is_date_list
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+manager = LocalProxy(current_manager)
+
+MAX_PAGE_SIZE = 1000
+DASHBOARD_WEEKS = 53  # heatmap weeks in /dashboard
+
+
+def error(message, status=400):
+    return jsonify({"error": message}), status
+
+
+@api.errorhandler(storage.DatabaseBusyError)
+def database_busy(e):
+    response, status = error("database is busy, retry later", 503)
+    response.headers["Retry-After"] = "1"
+    return response, status
+
+
+def _json_ids():
+    """Reads {"ids": [int, ...]} from the request body, or None if malformed."""
+    data = request.get_json(silent=True) or {}
+    ids = data.get("ids")
+    if not isinstance(ids, list) or not all(isinstance(i, int) for i in ids):
+        return None
+    return ids
+
+
+@api.route("/habits", methods=["GET"])
+def list_habits():
+    """All habits with due date, status and current/longest streaks."""
+    habits = manager.get_all_habits()
+    streaks = manager.get_streaks(h.id for h in habits)
+    result = []
+    for h in habits:
+        item = h.to_dict()
+        item["current_streak"], item["longest_streak"] = streaks[h.id]
+        result.append(item)
+    return jsonify({"habits": result})
+
+
+@api.route("/habits", methods=["POST"])
+def create_habits():
+    """
+    Bulk create: {"habits": [{"name": ..., "periodicity": ..., "active_days": [...]}, ...]}.
+    All habits are created in one transaction, or none if any is invalid.
+    """
+    data = request.get_json(silent=True) or {}
+    items = data.get("habits")
+    if not isinstance(items, list):
+        return error("expected a JSON object with a 'habits' list")
+
+    habits = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get("name"):
+            return error(f"habit {i}: 'name' is required")
+        if item.get("periodicity") not in PERIODICITIES:
+            return error(f"habit {i}: 'periodicity' must be one of {', '.join(PERIODICITIES)}")
+        active_days = item.get("active_days") or []
+        if not is_date_list(active_days):
+            return error(f"habit {i}: 'active_days' must be a list of YYYY-MM-DD dates")
+        habits.append((item["name"], item["periodicity"], active_days))
+
+    ids = manager.add_habits(habits)
+    return jsonify({"ids": ids}), 201
+
+
+@api.route("/habits/complete", methods=["POST"])
+def complete_habits():
+    """
+    Bulk complete: {"ids": [...]}. Returns the ids that were found and completed.
+    Repeating a request with the same Idempotency-Key header records nothing new.
+    """
+    ids = _json_ids()
+    if ids is None:
+        return error("expected a JSON object with an 'ids' list of integers")
+    return jsonify({"completed": manager.mark_habits_complete(ids, request.headers.get("Idempotency-Key"))})
+
+
+@api.route("/habits/delete", methods=["POST"])
+def delete_habits():
+    """Bulk delete: {"ids": [...]}."""
+    ids = _json_ids()
+    if ids is None:
+        return error("expected a JSON object with an 'ids' list of integers")
+    manager.delete_habits(ids)
+    return jsonify({"deleted": ids})
+
+
+@api.route("/habits/<int:habit_id>/completions", methods=["GET"])
+def list_completions(habit_id):
+    """
+    One page of completions, oldest first.
+    Query parameters: limit (default 100, max 1000) and after (the 'next'
+    cursor returned by the previous page).
+    """
+    if manager.get_habit_by_id(habit_id) is None:
+        return error("habit not found", 404)
+    try:
+        limit = int(request.args.get("limit", 100))
+    except ValueError:
+        return error("'limit' must be an integer")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    try:
+        completions, next_cursor = manager.get_completion_page(habit_id, after=request.args.get("after"), limit=limit)
+    except ValueError:
+        return error("'after' must be a cursor returned as 'next'")
+    return jsonify({"completions": completions, "next": next_cursor})
+
+
+_EXPORTS = {"habits": transfer.export_habits, "completions": transfer.export_completions}
+_IMPORTS = {"habits": transfer.import_habits, "completions": transfer.import_completions}
+_MIMETYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+
+@api.route("/export/<kind>.<fmt>", methods=["GET"])
+def export_data(kind, fmt):
+    """Streams all habits or completions as CSV or JSONL."""
+    if kind not in _EXPORTS or fmt not in transfer.FORMATS:
+        return error("unknown export", 404)
+    chunks = _EXPORTS[kind](fmt, manager.db_name)
+    return Response(stream_with_context(chunks), mimetype=_MIMETYPES[fmt], headers={
+        "Content-Disposition": f"attachment; filename={kind}.{fmt}"
+    })
+
+
+@api.route("/import/<kind>.<fmt>", methods=["POST"])
+def import_data(kind, fmt):
+    """
+    Imports habits or completions from the raw request body (CSV or JSONL),
+    reading it as a stream. Returns the number of imported rows.
+    """
+    if kind not in _IMPORTS or fmt not in transfer.FORMATS:
+        return error("unknown import", 404)
+    lines = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+    try:
+        imported = _IMPORTS[kind](lines, fmt, manager.db_name)
+    except transfer.InvalidRowError as e:
+        return error(str(e))
+    return jsonify({"imported": imported})
+
+
+@api.route("/heatmap", methods=["GET"])
+@api.route("/habits/<int:habit_id>/heatmap", methods=["GET"])
+def heatmap(habit_id=None):
+    """
+    Completions per day for one habit or all habits: {"days": {"YYYY-MM-DD": count}}.
+    Optional query parameters start and end (inclusive ISO dates).
+    """
+    if habit_id is not None and manager.get_habit_by_id(habit_id) is None:
+        return error("habit not found", 404)
+    days = manager.get_heatmap(habit_id, start=request.args.get("start"), end=request.args.get("end"))
+    return jsonify({"days": days})
+
+
+def dashboard_queries(today=None):
+    """
+    The HabitManager calls behind /dashboard as (method name, args) pairs;
+    they are independent, so the async server runs them concurrently.
+    """
+    today = today or date.today()
+    return [
+        ("get_all_habits", (Habit.SUMMARY_COLUMNS,)),
+        ("get_streaks", ()),
+        ("get_due_habits", (today.isoformat(), today.isoformat(), ("id", "name"))),
+        ("get_heatmap", (None, (today - timedelta(weeks=DASHBOARD_WEEKS)).isoformat(), today.isoformat())),
+    ]
+
+
+def dashboard_payload(habits, streaks, due, heatmap):
+    """Combines the results of dashboard_queries() into the /dashboard response."""
+    items = []
+    for h in habits:
+        item = h.to_dict()
+        del item["active_days"]  # not selected by SUMMARY_COLUMNS
+        item["current_streak"], item["longest_streak"] = streaks.get(h.id, (0, 0))
+        items.append(item)
+    return {"habits": items, "due_today": [h.id for h in due], "heatmap": heatmap}
+
+
+@api.route("/dashboard", methods=["GET"])
+def dashboard():
+    """
+    Everything a dashboard shows in one response: habits with streaks, the ids
+    due today and completions per day of the last DASHBOARD_WEEKS weeks.
+    """
+    results = [getattr(manager, name)(*args) for name, args in dashboard_queries()]
+    return jsonify(dashboard_payload(*results))
@@ -1,24 +1,199 @@
-from flask import Flask, render_template, request, redirect, url_for
+from flask import (Blueprint, Flask, Response, current_app, make_response, render_template, request, redirect,
+                   stream_with_context, url_for)
+import click
+import hashlib
 import json
-from habit_manager import HabitManager
+import os
+from datetime import date, timedelta
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+from werkzeug.local import LocalProxy
+from habit import Habit
+from utils import PERIODICITIES, heatmap_grid
+from page_cache import PageCache
+from api import api
+import assets
+from tenancy import current_manager
+import tenancy
+import scheduler
+import storage
+import transfer
 
-app = Flask(__name__)
-manager = HabitManager()  # Manager for all habit operations
+manager = LocalProxy(current_manager)  # Manager for all habit operations (per user in multi-tenant mode)
+COMPLETIONS_PAGE_SIZE = 100  # Completions shown per page on /habit/<id>
+HABITS_PAGE_SIZE = 50  # Habits shown per page on /
+HEATMAP_WEEKS = 53  # Weeks shown in the completion heatmaps
+COMPACT_AFTER_DAYS = int(os.environ.get("HABIT_TRACKER_COMPACT_AFTER_DAYS", 365))  # Default horizon of `flask compact`
 
-@app.route("/")
+# HTML views and `flask <name>` CLI commands; create_app registers them on each app.
+views = Blueprint("views", __name__, cli_group=None)
+
+
+def create_app(config=None):
+    """
+    Application factory. Cheap by design: it does not touch the database.
+    The schema is migrated when the first connection is opened (a single
+    PRAGMA user_version read once it is current) and the status rollover
+    starts in the background with the first request.
+    """
+    app = Flask(__name__)
+    app.config.update(
+        # "thread": roll statuses over in a background thread of this process,
+        # "external": a separate `python scheduler.py` worker does it, "off": never.
+        SCHEDULER=os.environ.get("HABIT_TRACKER_SCHEDULER", "thread"),
+        PAGE_CACHE_SIZE=256,
+        FRAGMENT_CACHE_SIZE=4096,
+        COMPRESSED_CACHE_SIZE=256,
+        # compiled templates are kept here across processes (None: a per-user temp directory)
+        JINJA_CACHE_DIR=os.environ.get("HABIT_TRACKER_JINJA_CACHE"),
+        PROFILE=os.environ.get("HABIT_TRACKER_PROFILE") == "1",
+    )
+    app.config.update(config or {})
+
+    app.jinja_options = {**app.jinja_options, "bytecode_cache": FileSystemBytecodeCache(app.config["JINJA_CACHE_DIR"])}
+    app.extensions["page_cache"] = PageCache(maxsize=app.config["PAGE_CACHE_SIZE"])  # Rendered read-only pages
+    app.extensions["fragment_cache"] = PageCache(maxsize=app.config["FRAGMENT_CACHE_SIZE"])  # Rendered table rows
+    app.extensions["rollover_scheduler"] = None
+    app.register_blueprint(views)
+    app.register_blueprint(api)
+    app.before_request(start_scheduler)
+    app.context_processor(template_helpers)
+    app.register_error_handler(storage.DatabaseBusyError, database_busy)
+    assets.enable(app)  # compression and hashed static URLs
+
+    if app.config["PROFILE"]:
+        import metrics
+        metrics.enable(app)  # Server-Timing headers and /_metrics
+    return app
+
+
+def start_scheduler():
+    """Starts the app's background rollover thread with its first request."""
+    if current_app.config["SCHEDULER"] == "thread" and current_app.extensions["rollover_scheduler"] is None:
+        rollover_scheduler = scheduler.RolloverScheduler()
+        current_app.extensions["rollover_scheduler"] = rollover_scheduler
+        rollover_scheduler.start()
+
+
+def stop_scheduler():
+    """Stops the app's background rollover thread, if it runs, and waits for it to finish."""
+    rollover_scheduler = current_app.extensions["rollover_scheduler"]
+    if rollover_scheduler is not None:
+        rollover_scheduler.stop()
+        rollover_scheduler.join()
+        current_app.extensions["rollover_scheduler"] = None
+
+
+def database_busy(e):
+    """Writes that could not get the database lock are answered with 503, to be retried."""
+    return "The database is busy, please try again.", 503, {"Retry-After": "1"}
+
+
+def cached_page(render):
+    """
+    Serves a read-only page through the app's page cache.
+    Pages are keyed by database, URL, data version and date; a hash of the
+    database plus the last two form the ETag, so a matching If-None-Match gets
+    a 304 without rendering. In multi-tenant mode responses vary on the tenant
+    header and are private, so no cache shows one user's page to another.
+    Non-string results (e.g. 404 tuples) are passed through uncached.
+    """
+    db_name = manager.db_name or storage.DB_NAME
+    db_tag = hashlib.blake2b(db_name.encode(), digest_size=6).hexdigest()
+    etag = f"{db_tag}-{manager.get_data_version()}-{date.today().isoformat()}"
+    if request.if_none_match.contains_weak(etag):  # compressed responses carry it as a weak ETag
+        response = current_app.response_class(status=304)
+    else:
+        page_cache = current_app.extensions["page_cache"]
+        key = (db_name, request.full_path, etag)
+        body = page_cache.get(key)
+        if body is None:
+            body = render()
+            if not isinstance(body, str):
+                return body
+            page_cache.set(key, body)
+        response = make_response(body)
+    response.set_etag(etag)
+    if tenancy.TENANT_HEADER:
+        response.vary.add(tenancy.TENANT_HEADER)
+        response.headers["Cache-Control"] = "private, no-cache"
+    else:
+        response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+def cached_fragment(template, key, **context):
+    """
+    Renders a partial template through the app's fragment cache, for table rows.
+    key must change whenever the output would, e.g. (habit id, habit version);
+    the database and today's date are added to it.
+    """
+    fragment_cache = current_app.extensions["fragment_cache"]
+    key = (manager.db_name or storage.DB_NAME, date.today(), template, *key)
+    html = fragment_cache.get(key)
+    if html is None:
+        html = Markup(current_app.jinja_env.get_template(template).render(**context))
+        fragment_cache.set(key, html)
+    return html
+
+
+def template_helpers():
+    return {"fragment": cached_fragment}
+
+
+@views.route("/")
 def index():
     """
-    Home page: displays all habits.
-    Checks and updates habit statuses (broken, renewed) on each visit.
-    Updates the current streak for each habit.
+    Home page: one page of habits with their current streak.
+    ?sort= (a HABIT_SORTS key, "-" for descending), ?filter= (name),
+    ?periodicity=, ?status= and ?page= are applied in SQL by query_habits.
+    Statuses (broken, renewed) are rolled over by the background scheduler,
+    so this is a pure read.
     """
-    manager.update_habit_statuses()
-    habits = manager.get_all_habits()
-    for h in habits:
-        h.current_streak = manager.get_streak(h.id)
-    return render_template("index.html", habits=habits)
+    query = {k: v for k in ("sort", "filter", "periodicity", "status") if (v := request.args.get(k, "").strip())}
+    page = request.args.get("page", 1, type=int)
+
+    def render():
+        try:
+            habits, has_next = manager.query_habits(**query, page=page, page_size=HABITS_PAGE_SIZE,
+                                                    columns=Habit.SUMMARY_COLUMNS)
+        except ValueError as e:
+            return str(e), 400
+        streaks = manager.get_streaks(h.id for h in habits)
+        for h in habits:
+            h.current_streak = streaks[h.id][0]
+        return render_template("index.html", habits=habits, query=query, sort=query.get("sort", "created"),
+                               page=page, has_next=has_next, periodicities=PERIODICITIES,
+                               statuses=Habit.STATUS_NAMES.values())
 
-@app.route("/create", methods=["GET", "POST"])
+    return cached_page(render)
+
+@views.route("/due")
+def due():
+    """
+    Habits due or scheduled today, or with ?span=week in the current
+    Monday-to-Sunday week.
+    """
+    span = "week" if request.args.get("span") == "week" else "today"
+    start = end = date.today()
+    if span == "week":
+        start -= timedelta(days=start.weekday())
+        end = start + timedelta(days=6)
+
+    def render():
+        habits = manager.get_due_habits(start.isoformat(), end.isoformat(), columns=Habit.SUMMARY_COLUMNS)
+        return render_template("due.html", habits=habits, span=span, start=start.isoformat(), end=end.isoformat())
+
+    return cached_page(render)
+
+def completion_heatmap(habit_id=None):
+    """Heatmap grid of the last HEATMAP_WEEKS weeks for one or all habits."""
+    today = date.today()
+    start = today - timedelta(weeks=HEATMAP_WEEKS)
+    counts = manager.get_heatmap(habit_id, start=start.isoformat(), end=today.isoformat())
+    return heatmap_grid(counts, today, HEATMAP_WEEKS)
+
+@views.route("/create", methods=["GET", "POST"])
 def create():
     """
     Create a new habit.
@@ -32,39 +207,37 @@ def create():
 
         date_list = [d.strip() for d in selected_dates.split(",") if d.strip()]
         manager.add_habit(name, periodicity, date_list)
-        return redirect(url_for("index"))
+        return redirect(url_for(".index"))
 
     return render_template("create.html")
 
-@app.route("/complete/<int:habit_id>")
+@views.route("/complete/<int:habit_id>")
 def complete(habit_id):
     """
     Mark a habit as completed for today.
+    The optional ?key= makes repeated requests idempotent.
     """
-    habit = manager.get_habit_by_id(habit_id)
-    if habit:
-        habit.mark_complete()
-    return redirect(url_for("index"))
+    manager.mark_habit_complete(habit_id, request.args.get("key") or None)
+    return redirect(url_for(".index"))
 
-@app.route("/uncomplete/<int:habit_id>")
+@views.route("/uncomplete/<int:habit_id>")
 def uncomplete(habit_id):
     """
     Mark a habit as broken (uncompleted) for today.
     """
-    habit = manager.get_habit_by_id(habit_id)
-    if habit:
-        habit.mark_broken()
-    return redirect(url_for("index"))
+    if manager.get_habit_by_id(habit_id):
+        manager.mark_habit_broken(habit_id)
+    return redirect(url_for(".index"))
 
-@app.route("/delete/<int:habit_id>")
+@views.route("/delete/<int:habit_id>")
 def delete_habit_route(habit_id):
     """
     Delete a habit by its ID.
     """
     manager.delete_habit(habit_id)
-    return redirect(url_for("index"))
+    return redirect(url_for(".index"))
 
-@app.route("/edit/<int:habit_id>", methods=["GET", "POST"])
+@views.route("/edit/<int:habit_id>", methods=["GET", "POST"])
 def edit_habit(habit_id):
     """
     Edit an existing habit.
@@ -80,51 +253,123 @@ def edit_habit(habit_id):
         periodicity = request.form["periodicity"]
         date_list = request.form.getlist("dates[]")
         manager.update_habit(habit_id, name, periodicity, date_list)
-        return redirect(url_for("habit_detail", habit_id=habit_id))
+        return redirect(url_for(".habit_detail", habit_id=habit_id))
 
     selected_dates = habit.active_days if habit.active_days else []
     return render_template("edit.html", habit=habit, selected_dates=selected_dates)
 
-@app.route("/habit/<int:habit_id>")
+@views.route("/habit/<int:habit_id>")
 def habit_detail(habit_id):
     """
     Display detailed information about a single habit,
-    including planned days and completion history.
+    including planned days and one page of its completion history.
+    ?after=<completed_at> continues the history after that completion.
     """
-    habit = manager.get_habit_by_id(habit_id)
-    if not habit:
+    def render():
+        habit = manager.get_habit_by_id(habit_id)
+        if not habit:
+            return "Habit not found", 404
+
+        selected_dates = habit.active_days if habit.active_days else []
+        try:
+            completions, next_after = manager.get_completion_page(
+                habit_id, after=request.args.get("after"), limit=COMPLETIONS_PAGE_SIZE)
+        except ValueError:
+            return "Invalid 'after' cursor", 400
+        return render_template("detail.html", habit=habit, selected_dates=selected_dates,
+                               completions=completions, next_after=next_after,
+                               heatmap=completion_heatmap(habit_id))
+
+    return cached_page(render)
+
+@views.route("/habit/<int:habit_id>/completions.csv")
+def export_completions(habit_id):
+    """
+    Download the full completion history as CSV, compacted days included
+    (see transfer.export_completions). Rows are streamed batch by batch, so
+    memory use does not grow with history length.
+    """
+    if manager.get_habit_by_id(habit_id) is None:
         return "Habit not found", 404
 
-    selected_dates = habit.active_days if habit.active_days else []
-    completions = manager.get_completions(habit_id)
-    return render_template("detail.html", habit=habit, selected_dates=selected_dates, completions=completions)
+    chunks = transfer.export_completions("csv", manager.db_name, habit_id=habit_id)
+    return Response(stream_with_context(chunks), mimetype="text/csv", headers={
+        "Content-Disposition": f"attachment; filename=habit_{habit_id}_completions.csv"
+    })
 
-@app.route("/analysis")
+@views.route("/analysis")
 def analysis():
     """
     Show analysis of all habits.
-    Breaks down habits by periodicity and finds the habit with the longest streak.
-    """
-    habits = manager.get_all_habits()
-    daily_habits = manager.get_habits_by_periodicity("daily")
-    weekly_habits = manager.get_habits_by_periodicity("weekly")
-    monthly_habits = manager.get_habits_by_periodicity("monthly")
-    yearly_habits = manager.get_habits_by_periodicity("yearly")
-    longest_habit, longest_streak = manager.get_longest_streak_overall()
-
-    return render_template(
-        "analysis.html",
-        habits=habits,
-        daily_habits=daily_habits,
-        weekly_habits=weekly_habits,
-        monthly_habits=monthly_habits,
-        yearly_habits=yearly_habits,
-        longest_habit=longest_habit,
-        longest_streak=longest_streak
-    )
+    Per-habit streaks and completion rates, totals per periodicity and the
+    habit with the longest streak, all computed from a single data load.
+    """
+    import analytics  # pandas/numpy are only loaded once the page is first requested
+    return cached_page(lambda: render_template(
+        "analysis.html", heatmap=completion_heatmap(),
+        **analytics.build_report(storage.get_connection(manager.db_name))))
+
+@views.cli.command("rebuild-streaks")
+def rebuild_streaks_command():
+    """Recompute the streak cache for all habits from their completions."""
+    manager.rebuild_streaks()
+    click.echo("Streak cache rebuilt.")
+
+@views.cli.command("rebuild-heatmap")
+def rebuild_heatmap_command():
+    """Backfill the per-day completion counts used by the heatmaps."""
+    manager.rebuild_heatmap()
+    click.echo("Heatmap aggregate rebuilt.")
+
+@views.cli.command("compact")
+@click.option("--days", type=click.IntRange(min=1), default=COMPACT_AFTER_DAYS, show_default=True,
+              help="compact completions older than this many days")
+@click.option("--archive", type=click.Path(dir_okay=False, writable=True), help="copy the raw rows to this file first")
+@click.option("--vacuum", type=click.Choice(["incremental", "full", "none"]), default="incremental", show_default=True)
+def compact_command(days, archive, vacuum):
+    """Roll old completions into per-day summaries and reclaim the space."""
+    before = date.today() - timedelta(days=days)
+    count = manager.compact_completions(before, archive)
+    if vacuum != "none":
+        storage.vacuum(manager.db_name, vacuum)
+    click.echo(f"Compacted {count} completions before {before}.")
+
+@views.cli.command("export-data")
+@click.argument("kind", type=click.Choice(["habits", "completions"]))
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option("--format", "fmt", type=click.Choice(transfer.FORMATS), default="csv")
+def export_data_command(kind, path, fmt):
+    """Write all habits or completions to PATH as CSV or JSONL."""
+    export = transfer.export_habits if kind == "habits" else transfer.export_completions
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        for chunk in export(fmt):
+            f.write(chunk)
+
+@views.cli.command("import-data")
+@click.argument("kind", type=click.Choice(["habits", "completions"]))
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(transfer.FORMATS), default="csv")
+def import_data_command(kind, path, fmt):
+    """Import habits or completions from a CSV or JSONL file at PATH."""
+    load = transfer.import_habits if kind == "habits" else transfer.import_completions
+    with open(path, encoding="utf-8", newline="") as f:
+        try:
+            count = load(f, fmt)
+        except transfer.InvalidRowError as e:
+            raise click.ClickException(str(e))
+    click.echo(f"Imported {count} {kind}.")
+
+@views.cli.command("migrate-to-tenant")
+@click.argument("user_id")
+def migrate_to_tenant_command(user_id):
+    """Copy the shared database into USER_ID's own database file."""
+    target = storage.tenant_db_path(user_id)
+    if os.path.exists(target):
+        raise click.ClickException(f"{target} already exists")
+    storage.copy_database(storage.DB_NAME, target)
+    click.echo(f"Copied {storage.DB_NAME} to {target}.")
+
+app = create_app()  # for `flask run`, WSGI servers and `python app.py`
 
 if __name__ == "__main__":
-    from storage import init_db
-    init_db()  # Initialize the database
-    manager.update_habit_statuses()  # Ensure statuses are up to date on startup
-    app.run(debug=True)
+    app.run(debug=True)  # the schema is migrated on first use, statuses rolled over in the background
@@ -0,0 +1,259 @@
+# asgi.py
+"""
+Async serving mode.
+
+`application` is an ASGI app. Only GET /api/v1/dashboard has a native async
+handler, whose reads run concurrently through AsyncHabitManager (add more
+to Application.ROUTES). Every other request, HTML and JSON alike, is passed
+to the Flask app by WsgiBridge and runs synchronously on a bounded thread
+pool, so the whole site works unchanged. Run it with
+
+    python serve.py --mode async --workers 4
+
+under uvicorn, or with `uvicorn asgi:application --reload` in development.
+"""
+import asyncio
+import io
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import api
+import async_manager
+from async_manager import AsyncHabitManager
+from habit_manager import HabitManager
+from storage import DatabaseBusyError
+from tenancy import TENANT_HEADER
+
+WSGI_THREADS = int(os.environ.get("HABIT_TRACKER_WSGI_THREADS", 16))  # Flask requests in flight per process
+
+_END = object()
+
+
+class _Disconnected(Exception):
+    """Raised in a WsgiBridge worker once nobody reads the response any more."""
+
+
+class WsgiBridge:
+    """
+    Runs a WSGI app for ASGI HTTP requests on a thread pool. The response is
+    iterated on the worker thread and handed to the event loop chunk by
+    chunk, so streamed responses (CSV exports) stay streamed.
+    """
+
+    def __init__(self, wsgi_app, threads=WSGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="wsgi")
+
+    async def __call__(self, scope, receive, send):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=8)
+        disconnected = threading.Event()
+        body = io.BufferedReader(_RequestBody(receive, loop, disconnected))
+
+        def put(item):
+            if disconnected.is_set():
+                raise _Disconnected
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        def run():
+            response = {}
+
+            def start_response(status, headers, exc_info=None):
+                response["status"] = int(status.split(" ", 1)[0])
+                response["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+            try:
+                try:
+                    result = self.wsgi_app(_environ(scope, body), start_response)
+                    started = False
+                    try:
+                        for chunk in result:
+                            if not started:
+                                put((response["status"], response["headers"]))
+                                started = True
+                            if chunk:
+                                put(chunk)
+                    finally:
+                        if hasattr(result, "close"):
+                            result.close()
+                    if not started:
+                        put((response["status"], response["headers"]))
+                except _Disconnected:
+                    raise
+                except BaseException as e:
+                    put(e)
+                put(_END)
+            except _Disconnected:
+                pass  # the client is gone; the response was closed above
+
+        future = loop.run_in_executor(self.executor, run)
+        started = False
+        try:
+            while (item := await queue.get()) is not _END:
+                if isinstance(item, BaseException):
+                    await future
+                    if started:
+                        raise item
+                    return await _send_response(send, 500, [(b"content-type", b"text/plain")], b"Internal Server Error")
+                if isinstance(item, tuple):
+                    await send({"type": "http.response.start", "status": item[0], "headers": item[1]})
+                    started = True
+                else:
+                    await send({"type": "http.response.body", "body": item, "more_body": True})
+            await future
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            if not future.done():
+                # send failed (client disconnected) or we were cancelled: stop the worker.
+                # Draining wakes a put() blocked on the full queue; the next one raises.
+                disconnected.set()
+                while not queue.empty():
+                    queue.get_nowait()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class _RequestBody(io.RawIOBase):
+    """
+    wsgi.input of a WsgiBridge worker: the request body is pulled from the
+    event loop one receive() message at a time, as the WSGI app reads it,
+    so uploads (imports) are never held in memory as a whole.
+    """
+
+    def __init__(self, receive, loop, disconnected):
+        self._receive = receive
+        self._loop = loop
+        self._disconnected = disconnected
+        self._chunk = memoryview(b"")
+        self._more = True
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._chunk and self._more:
+            if self._disconnected.is_set():
+                raise _Disconnected
+            message = asyncio.run_coroutine_threadsafe(self._receive(), self._loop).result()
+            # http.disconnect ends the body early; the response then goes nowhere
+            self._more = message["type"] == "http.request" and message.get("more_body", False)
+            self._chunk = memoryview(message.get("body", b""))
+        n = min(len(buffer), len(self._chunk))
+        buffer[:n] = self._chunk[:n]
+        self._chunk = self._chunk[n:]
+        return n
+
+
+def _environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", ""),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": (scope.get("client") or ("", 0))[0],
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.input_terminated": True,  # read to EOF, also without a content-length
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope["headers"]:
+        key = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            key = f"HTTP_{key}"
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def _send_response(send, status, headers, body):
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body, "more_body": False})
+
+
+async def _send_json(send, payload, status=200, headers=()):
+    body = json.dumps(payload).encode()
+    await _send_response(send, status, [(b"content-type", b"application/json"), *headers], body)
+
+
+_shared_manager = AsyncHabitManager()
+
+
+def _manager_for(scope):
+    """Like tenancy.current_manager: the user's own database in multi-tenant mode."""
+    if not TENANT_HEADER:
+        return _shared_manager
+    user_id = dict(scope["headers"]).get(TENANT_HEADER.lower().encode("latin-1"))
+    if not user_id:
+        raise PermissionError
+    return AsyncHabitManager(HabitManager.for_tenant(user_id.decode("latin-1")))
+
+
+async def dashboard(scope, send):
+    """GET /api/v1/dashboard, the same response as api.dashboard with its reads awaited together."""
+    try:
+        manager = _manager_for(scope)
+        results = await asyncio.gather(*(getattr(manager, name)(*args) for name, args in api.dashboard_queries()))
+    except PermissionError:
+        return await _send_json(send, {"error": "unauthorized"}, 401)
+    except ValueError:
+        return await _send_json(send, {"error": "invalid user id"}, 400)
+    except DatabaseBusyError:  # as api.database_busy
+        return await _send_json(send, {"error": "database is busy, retry later"}, 503, [(b"retry-after", b"1")])
+    await _send_json(send, api.dashboard_payload(*results))
+
+
+class Application:
+    """ASGI app: async handlers for ROUTES, the Flask app for everything else."""
+
+    ROUTES = {("GET", "/api/v1/dashboard"): dashboard}
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.fallback = WsgiBridge(wsgi_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+        handler = self.ROUTES.get((scope["method"], scope["path"]))
+        if handler is None:
+            return await self.fallback(scope, receive, send)
+        await handler(scope, send)
+
+    async def _lifespan(self, receive, send):
+        from app import start_scheduler, stop_scheduler
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                # the rollover must not wait for the first request that reaches Flask
+                with self.wsgi_app.app_context():
+                    start_scheduler()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                with self.wsgi_app.app_context():
+                    await asyncio.to_thread(stop_scheduler)
+                async_manager.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+def create_application():
+    from app import create_app
+    return Application(create_app())
+
+
+application = create_application()
+
@@ -0,0 +1,107 @@
+# assets.py
+"""
+Response compression and static asset caching.
+
+enable(app) compresses text responses with brotli (when the optional Brotli
+package is installed) or gzip, whichever the client accepts. Static URLs
+built with url_for get a content hash (?v=<hash>); requests carrying the
+current hash are answered with a one-year immutable Cache-Control, so a
+changed file simply gets a new URL. Compressed bodies are cached by content,
+so unchanged pages and assets are compressed once per process.
+"""
+import gzip
+import hashlib
+import os
+
+from flask import current_app, request
+
+from page_cache import PageCache
+
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+
+COMPRESS_MIN_SIZE = 512  # bytes; smaller bodies are sent as they are
+COMPRESSIBLE_TYPES = {"text/html", "text/css", "text/plain", "text/csv", "text/javascript",
+                      "application/javascript", "application/json", "image/svg+xml"}
+STATIC_MAX_AGE = 365 * 24 * 3600  # seconds hashed static URLs may be cached
+
+_hashes = {}  # static file path -> (mtime_ns, content hash)
+
+
+def enable(app):
+    app.extensions["compressed_cache"] = PageCache(maxsize=app.config["COMPRESSED_CACHE_SIZE"])
+    app.url_defaults(_add_static_hash)
+    app.after_request(_after_request)
+
+
+def static_hash(filename, app=None):
+    """Short content hash of a file in the static folder, or None if it does not exist."""
+    path = os.path.join((app or current_app).static_folder, filename)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    cached = _hashes.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, "rb") as f:
+            cached = _hashes[path] = (mtime, hashlib.sha256(f.read()).hexdigest()[:12])
+    return cached[1]
+
+
+def _add_static_hash(endpoint, values):
+    if endpoint == "static" and "v" not in values:
+        digest = static_hash(values.get("filename", ""))
+        if digest:
+            values["v"] = digest
+
+
+def _after_request(response):
+    if request.endpoint == "static" and request.args.get("v"):
+        if request.args["v"] == static_hash(request.view_args["filename"]):
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = STATIC_MAX_AGE
+            response.cache_control.immutable = True
+    return compress(response)
+
+
+def _accepted_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted["br"]:
+        return "br"
+    if accepted["gzip"]:
+        return "gzip"
+    return None
+
+
+def compress(response):
+    """Compresses a complete 200 text response for the current request, if the client accepts it."""
+    if response.mimetype not in COMPRESSIBLE_TYPES or "Content-Encoding" in response.headers:
+        return response
+    response.vary.add("Accept-Encoding")
+    # streamed bodies (exports) stay streamed; static files are read once into memory
+    if response.status_code != 200 or (response.is_streamed and request.endpoint != "static"):
+        return response
+    encoding = _accepted_encoding()
+    if encoding is None:
+        return response
+
+    response.direct_passthrough = False
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_SIZE:
+        return response
+    compressed_cache = current_app.extensions["compressed_cache"]
+    key = (encoding, hashlib.blake2b(body, digest_size=16).digest())
+    compressed = compressed_cache.get(key)
+    if compressed is None:
+        compressed = brotli.compress(body) if encoding == "br" else gzip.compress(body, compresslevel=6)
+        compressed_cache.set(key, compressed)
+
+    response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)  # same content, different bytes
+    return response
@@ -0,0 +1,57 @@
+# async_manager.py
+"""
+Awaitable facade over HabitManager for the async serving mode (see asgi.py).
+
+Every public HabitManager method becomes a coroutine that runs the blocking
+SQLite work on a bounded thread pool. Pool threads keep their own pooled
+connections, so reads awaited together with asyncio.gather run in parallel
+under WAL while the event loop keeps serving other clients.
+"""
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from habit_manager import HabitManager
+
+DB_THREADS = int(os.environ.get("HABIT_TRACKER_DB_THREADS", 8))  # SQLite calls in flight per process
+
+_executor = None
+
+
+def executor():
+    """The process-wide pool SQLite work runs on, created on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(DB_THREADS, thread_name_prefix="sqlite")
+    return _executor
+
+
+def shutdown():
+    """Waits for running calls and stops the pool; the next call starts a new one."""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+class AsyncHabitManager:
+    """
+    AsyncHabitManager(manager).get_all_habits() etc. return coroutines with
+    the results of the wrapped manager's methods.
+    """
+
+    def __init__(self, manager=None):
+        self.manager = manager or HabitManager()
+
+    def __getattr__(self, name):
+        method = getattr(self.manager, name)
+        if name.startswith("_") or not callable(method):
+            return method
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor(), functools.partial(method, *args, **kwargs))
+
+        call.__name__ = name
+        return call
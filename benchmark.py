@@ -0,0 +1,271 @@
+# benchmark.py
+"""
+Performance benchmarks for the habit tracker hot paths.
+
+Generates a synthetic database with the storage schema, times the hot
+paths and writes the results as JSON so runs can be compared:
+
+    python benchmark.py --habits 500 --years 3 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import serve
+import storage
+from utils import PERIODICITIES, calculate_next_due_date
+
+# Days between completions for each periodicity before random skips.
+PERIOD_STEP = {"daily": 1, "weekly": 7, "monthly": 30, "yearly": 365}
+
+
+def generate_db(path, habits=200, years=2, completion_rate=0.8, seed=0):
+    """
+    Creates a database at path with `habits` habits of mixed periodicity and
+    `years` years of completions, each period completed with probability
+    completion_rate. Returns the number of completions written.
+    """
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    storage.DB_NAME = path
+    conn = storage.get_connection()
+
+    now = datetime.now()
+    start = now - timedelta(days=365 * years)
+    habit_rows = []
+    for i in range(habits):
+        periodicity = rng.choice(PERIODICITIES)
+        active_days = [(start + timedelta(days=rng.randrange(30))).date().isoformat()]
+        due = (now - timedelta(days=rng.randrange(1, 30))).date().isoformat()
+        habit_rows.append((f"habit {i}", periodicity, start.isoformat(), json.dumps(active_days), due))
+
+    total = 0
+    with storage.transaction() as conn:
+        conn.executemany("""
+            INSERT INTO habits (name, periodicity, created_at, active_days, due_date, completed)
+            VALUES (?, ?, ?, ?, ?, 0)
+        """, habit_rows)
+        ids = [r["id"] for r in conn.execute("SELECT id FROM habits ORDER BY id")]
+        for habit_id, (_, periodicity, *_rest) in zip(ids, habit_rows):
+            step = timedelta(days=PERIOD_STEP[periodicity])
+            day, batch = start, []
+            while day < now:
+                if rng.random() < completion_rate:
+                    batch.append((habit_id, (day + timedelta(minutes=rng.randrange(1440))).isoformat()))
+                day += step
+            conn.executemany("INSERT INTO completions (habit_id, completed_at) VALUES (?, ?)", batch)
+            total += len(batch)
+    return total
+
+
+def timed(fn, repeat=5, setup=None):
+    """Runs fn `repeat` times (after setup, which is not timed); returns stats in ms."""
+    samples = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return {
+        "min_ms": round(min(samples), 3),
+        "median_ms": round(statistics.median(samples), 3),
+        "mean_ms": round(statistics.fmean(samples), 3),
+        "repeat": repeat,
+    }
+
+
+def run_benchmarks(repeat=5):
+    """Times the hot paths against the current storage.DB_NAME."""
+    from habit_manager import HabitManager
+    os.environ.setdefault("HABIT_TRACKER_SCHEDULER", "off")  # rollovers are timed explicitly below
+    import app as app_module
+
+    manager = HabitManager()
+    conn = storage.get_connection()
+    habit_ids = [r["id"] for r in conn.execute("SELECT id FROM habits")]
+    schedules = [{"periodicity": r["periodicity"], "active_days": json.loads(r["active_days"])}
+                 for r in conn.execute("SELECT periodicity, active_days FROM habits")]
+
+    def make_overdue():
+        with storage.transaction() as c:
+            c.execute("DELETE FROM app_state WHERE key = 'last_rollover'")
+            c.execute("UPDATE habits SET due_date = date('now', '-1 day')")
+
+    def invalidate_streaks():
+        with storage.transaction() as c:
+            c.execute("UPDATE habit_streaks SET stale = 1")
+
+    client = app_module.app.test_client()
+    page_cache = app_module.app.extensions["page_cache"]
+    results = {}
+    results["update_habit_statuses.rollover"] = timed(manager.update_habit_statuses, repeat, setup=make_overdue)
+    results["update_habit_statuses.noop"] = timed(manager.update_habit_statuses, repeat)
+    results["get_streak.all_habits.cold"] = timed(
+        lambda: [manager.get_streak(h) for h in habit_ids], repeat, setup=invalidate_streaks)
+    results["get_streak.all_habits.warm"] = timed(lambda: [manager.get_streak(h) for h in habit_ids], repeat)
+    results["get_longest_streak_overall"] = timed(manager.get_longest_streak_overall, repeat)
+    results["calculate_next_due_date.all_habits"] = timed(
+        lambda: [calculate_next_due_date(s) for s in schedules], repeat)
+    results["render.index.uncached"] = timed(lambda: client.get("/"), repeat, setup=page_cache.clear)
+    results["render.index.cached"] = timed(lambda: client.get("/"), repeat)
+    results["render.analysis.uncached"] = timed(
+        lambda: client.get("/analysis"), repeat, setup=page_cache.clear)
+    results["render.analysis.cached"] = timed(lambda: client.get("/analysis"), repeat)
+    return results
+
+
+# Run in a fresh interpreter: import the app, build it and serve its first request.
+STARTUP_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+import app
+t1 = time.perf_counter()
+instance = app.create_app()
+t2 = time.perf_counter()
+instance.test_client().get("/")
+t3 = time.perf_counter()
+json.dump({"import": t1 - t0, "create_app": t2 - t1, "first_request": t3 - t2}, sys.stdout)
+"""
+
+
+def startup_benchmarks(repeat=5):
+    """Times a cold start of the app in fresh processes against the current storage.DB_NAME."""
+    env = dict(os.environ, HABIT_TRACKER_DB=storage.DB_NAME, HABIT_TRACKER_SCHEDULER="off")
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    samples = {}
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], env=env, cwd=cwd,
+                             capture_output=True, text=True, check=True).stdout
+        for phase, seconds in json.loads(out).items():
+            samples.setdefault(phase, []).append(seconds * 1000)
+    return {
+        f"startup.{phase}": {
+            "min_ms": round(min(values), 3),
+            "median_ms": round(statistics.median(values), 3),
+            "mean_ms": round(statistics.fmean(values), 3),
+            "repeat": repeat,
+        }
+        for phase, values in samples.items()
+    }
+
+
+def _wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return urllib.request.urlopen(url, timeout=5).read()
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def serving_benchmarks(workers=2, concurrency=32, requests=500, path="/api/v1/dashboard"):
+    """
+    Serves the current storage.DB_NAME with serve.py in sync and in async mode
+    and sends `requests` GETs of path from `concurrency` client threads to each.
+    A mode whose server (gunicorn or uvicorn) is not installed is skipped.
+    """
+    env = dict(os.environ, HABIT_TRACKER_DB=storage.DB_NAME, HABIT_TRACKER_SCHEDULER="off")
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for mode, server_name in (("sync", "gunicorn"), ("async", "uvicorn")):
+        if not serve._installed(server_name):
+            results[f"serve.{mode}"] = {"skipped": f"{server_name} is not installed"}
+            continue
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        server = subprocess.Popen([sys.executable, "serve.py", "--mode", mode, "--workers", str(workers),
+                                   "--port", str(port)], env=env, cwd=cwd,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            url = f"http://127.0.0.1:{port}{path}"
+            _wait_for(url)
+
+            def fetch(_):
+                t0 = time.perf_counter()
+                urllib.request.urlopen(url, timeout=60).read()
+                return (time.perf_counter() - t0) * 1000
+
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as pool:
+                latencies = sorted(pool.map(fetch, range(requests)))
+            elapsed = time.perf_counter() - t0
+        finally:
+            server.terminate()
+            server.wait()
+        results[f"serve.{mode}"] = {
+            "requests_per_second": round(requests / elapsed, 1),
+            "p50_ms": round(latencies[len(latencies) // 2], 3),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95)], 3),
+            "server": server_name,
+            "workers": workers,
+            "concurrency": concurrency,
+            "requests": requests,
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the habit tracker hot paths.")
+    parser.add_argument("--habits", type=int, default=200, help="number of synthetic habits")
+    parser.add_argument("--years", type=float, default=2, help="years of completion history")
+    parser.add_argument("--completion-rate", type=float, default=0.8, help="share of periods completed")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--db", help="database path (default: a temporary file)")
+    parser.add_argument("--output", help="write JSON results here instead of stdout")
+    parser.add_argument("--serving", action="store_true", help="also compare the sync and async servers")
+    parser.add_argument("--workers", type=int, default=2, help="server processes for --serving")
+    parser.add_argument("--concurrency", type=int, default=32, help="client threads for --serving")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db = args.db or os.path.join(tmp, "bench.db")
+        t0 = time.perf_counter()
+        completions = generate_db(db, args.habits, args.years, args.completion_rate, args.seed)
+        generate_ms = (time.perf_counter() - t0) * 1000
+        results = run_benchmarks(args.repeat)
+        results.update(startup_benchmarks(args.repeat))
+        if args.serving:
+            results.update(serving_benchmarks(args.workers, args.concurrency))
+        storage.close_connections()
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "dataset": {
+            "habits": args.habits,
+            "years": args.years,
+            "completion_rate": args.completion_rate,
+            "seed": args.seed,
+            "completions": completions,
+            "generate_ms": round(generate_ms, 3),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,35 +2,84 @@
 import json
 from datetime import datetime
 
+_current_manager = None  # tenancy.current_manager, imported on first use (tenancy imports this module)
+
+
+def _manager():
+    """The HabitManager of the current request, or the shared one outside of requests."""
+    global _current_manager
+    if _current_manager is None:
+        from tenancy import current_manager
+        _current_manager = current_manager
+    return _current_manager()
+
 
 class Habit:
     """
     Represents a habit in the database.
+    Uses __slots__ to keep instances small; active_days is decoded from its
+    JSON column only when first accessed. Columns a query did not select are None.
     """
-    def __init__(self, id, name, periodicity, created_at, start_date=None, due_date=None, active_days=None, completed=0):
+    __slots__ = ("id", "name", "periodicity", "created_at", "start_date", "due_date", "completed",
+                 "version", "_active_days", "_active_days_json", "current_streak", "longest_streak")
+
+    # Columns needed to list habits (no active_days / start_date).
+    SUMMARY_COLUMNS = ("id", "name", "periodicity", "created_at", "due_date", "completed", "version")
+
+    def __init__(self, id, name, periodicity=None, created_at=None, start_date=None, due_date=None, active_days=None,
+                 completed=0, version=None, current_streak=None, longest_streak=None):
         self.id = id
         self.name = name
         self.periodicity = periodicity
         self.created_at = created_at
         self.start_date = start_date
         self.due_date = due_date
-        self.active_days = json.loads(active_days) if isinstance(active_days, str) else active_days
+        self.active_days = active_days
         self.completed = completed
+        self.version = version  # bumped on every change to the habit or its completions
+        self.current_streak = current_streak  # computed values, filled in by callers that need them
+        self.longest_streak = longest_streak
+
+    @property
+    def active_days(self):
+        if self._active_days_json is not None:
+            self._active_days = json.loads(self._active_days_json)
+            self._active_days_json = None
+        return self._active_days
+
+    @active_days.setter
+    def active_days(self, value):
+        if isinstance(value, str):
+            self._active_days, self._active_days_json = None, value
+        else:
+            self._active_days, self._active_days_json = value, None
 
     @classmethod
     def from_row(cls, row):
         """Creates a Habit object from a database row."""
         return cls(**dict(row))
 
+    STATUS_NAMES = {0: "open", 1: "completed", 2: "broken"}
+
+    def to_dict(self):
+        """JSON-serializable representation used by the API."""
+        return {
+            "id": self.id,
+            "name": self.name,
+            "periodicity": self.periodicity,
+            "created_at": self.created_at,
+            "due_date": self.due_date,
+            "active_days": self.active_days or [],
+            "status": self.STATUS_NAMES.get(self.completed, "open"),
+        }
+
     def mark_complete(self):
         """Marks this habit as completed."""
-        from habit_manager import HabitManager
-        HabitManager().mark_habit_complete(self.id)
+        _manager().mark_habit_complete(self.id)
 
     def mark_broken(self):
         """Marks this habit as broken."""
-        from habit_manager import HabitManager
-        HabitManager().mark_habit_broken(self.id)
+        _manager().mark_habit_broken(self.id)
 
     def __repr__(self):
         return f"<Habit {self.id}: {self.name} ({self.periodicity}), status={self.completed}>"
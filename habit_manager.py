@@ -1,28 +1,43 @@
 # habit_manager.py
 import json
+import re
 from datetime import datetime
-from storage import get_connection
+from itertools import groupby
+from storage import (ALL_COMPLETIONS, archive_completions, bump_data_version, get_connection, get_data_version, get_state,
+                     rebuild_completion_days, set_state, tenant_db_path, transaction)
 from utils import calculate_next_due_date
 from habit import Habit
+import streaks
 
 class HabitManager:
-    """Encapsulates all CRUD and logic functions for habits."""
+    """
+    Encapsulates all CRUD and logic functions for habits.
+    db_name selects the database file (see storage.tenant_db_path);
+    None means storage.DB_NAME, resolved on every call.
+    """
+
+    def __init__(self, db_name=None):
+        self.db_name = db_name
+
+    @classmethod
+    def for_tenant(cls, user_id):
+        """Manager scoped to one user's own database file."""
+        return cls(tenant_db_path(user_id))
 
     # --- CRUD ---
     def add_habit(self, name, periodicity, date_list):
-        conn = get_connection()
-        c = conn.cursor()
         created_at = datetime.now().isoformat()
         selected_dates = json.dumps(date_list)
         habit_dict = {"periodicity": periodicity, "active_days": date_list}
         due_date = calculate_next_due_date(habit_dict)
 
-        c.execute("""
-            INSERT INTO habits (name, periodicity, created_at, active_days, due_date, completed)
-            VALUES (?, ?, ?, ?, ?, 0)
-        """, (name, periodicity, created_at, selected_dates, due_date))
-        conn.commit()
-        conn.close()
+        with transaction(immediate=True, db_name=self.db_name) as conn:
+            cur = conn.execute("""
+                INSERT INTO habits (name, periodicity, created_at, active_days, due_date, completed)
+                VALUES (?, ?, ?, ?, ?, 0)
+            """, (name, periodicity, created_at, selected_dates, due_date))
+            bump_data_version(conn)
+        return cur.lastrowid
 
     def update_habit(self, habit_id, name, periodicity, date_list):
         if isinstance(date_list, str):
@@ -30,197 +45,445 @@ class HabitManager:
         elif isinstance(date_list, list) and len(date_list) == 1 and "," in date_list[0]:
             date_list = [d.strip() for d in date_list[0].split(",") if d.strip()]
 
-        conn = get_connection()
-        c = conn.cursor()
         selected_dates = json.dumps(date_list)
         habit_dict = {"periodicity": periodicity, "active_days": date_list}
         due_date = calculate_next_due_date(habit_dict)
 
-        c.execute("""
-            UPDATE habits SET name = ?, periodicity = ?, active_days = ?, due_date = ?
-            WHERE id = ?
-        """, (name, periodicity, selected_dates, due_date, habit_id))
-        conn.commit()
-        conn.close()
+        with transaction(immediate=True, db_name=self.db_name) as conn:
+            row = conn.execute("SELECT periodicity FROM habits WHERE id = ?", (habit_id,)).fetchone()
+            conn.execute("""
+                UPDATE habits SET name = ?, periodicity = ?, active_days = ?, due_date = ?
+                WHERE id = ?
+            """, (name, periodicity, selected_dates, due_date, habit_id))
+            if row and row["periodicity"] != periodicity:
+                _rebuild_streaks(conn, [habit_id])
+            bump_data_version(conn)
 
     def delete_habit(self, habit_id):
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("DELETE FROM completions WHERE habit_id = ?", (habit_id,))
-        c.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
-        conn.commit()
-        conn.close()
+        with transaction(immediate=True, db_name=self.db_name) as conn:
+            conn.execute("DELETE FROM completions WHERE habit_id = ?", (habit_id,))
+            conn.execute("DELETE FROM completion_summaries WHERE habit_id = ?", (habit_id,))
+            conn.execute("DELETE FROM completion_days WHERE habit_id = ?", (habit_id,))
+            conn.execute("DELETE FROM habits WHERE id = ?", (habit_id,))
+            conn.execute("DELETE FROM habit_streaks WHERE habit_id = ?", (habit_id,))
+            bump_data_version(conn)
+
+    # --- Bulk ---
+    # Each bulk call runs as one transaction; the single-item methods it calls
+    # join it instead of committing on their own.
+    def add_habits(self, habits):
+        """habits: iterable of (name, periodicity, date_list). Returns the new ids."""
+        with transaction(immediate=True, db_name=self.db_name):
+            return [self.add_habit(name, periodicity, date_list) for name, periodicity, date_list in habits]
+
+    def mark_habits_complete(self, habit_ids, request_key=None):
+        """Returns the ids that existed and were marked complete."""
+        with transaction(immediate=True, db_name=self.db_name):
+            return [habit_id for habit_id in habit_ids if self.mark_habit_complete(habit_id, request_key)]
+
+    def delete_habits(self, habit_ids):
+        with transaction(immediate=True, db_name=self.db_name):
+            for habit_id in habit_ids:
+                self.delete_habit(habit_id)
 
     # --- Status ---
-    def mark_habit_complete(self, habit_id):
-        conn = get_connection()
-        c = conn.cursor()
+    def mark_habit_complete(self, habit_id, request_key=None):
+        """
+        Records a completion now. Returns False if the habit does not exist.
+        request_key makes the call idempotent: a repeated call with the same key
+        for the same habit (a retry or double submit) changes nothing.
+        """
         completed_at = datetime.now().isoformat()
 
-        c.execute("SELECT * FROM habits WHERE id = ?", (habit_id,))
-        row = c.fetchone()
-        if not row:
-            conn.close()
-            return
-
-        habit = Habit.from_row(row)
-        habit_dict = {
-            "periodicity": habit.periodicity,
-            "active_days": habit.active_days or []
-        }
-        new_due_date = calculate_next_due_date(habit_dict)
-
-        c.execute("INSERT INTO completions (habit_id, completed_at) VALUES (?, ?)", (habit_id, completed_at))
-        c.execute("UPDATE habits SET completed = 1, due_date = ? WHERE id = ?", (new_due_date, habit_id))
-        conn.commit()
-        conn.close()
+        with transaction(immediate=True, db_name=self.db_name) as conn:
+            today = datetime.now().date()
+            row = conn.execute(f"SELECT periodicity, {_SCHEDULE_ANCHOR} AS anchor FROM habits h WHERE id = :id",
+                               {"id": habit_id, "today": today.isoformat()}).fetchone()
+            if not row:
+                return False
+            new_due_date = _next_due_date(row["periodicity"], row["anchor"], today)
+
+            cached = conn.execute("""
+                SELECT last_completed_at, current_run, longest_streak, stale
+                FROM habit_streaks WHERE habit_id = ?
+            """, (habit_id,)).fetchone()
+
+            inserted = conn.execute("""
+                INSERT INTO completions (habit_id, completed_at, request_key) VALUES (?, ?, ?)
+                ON CONFLICT DO NOTHING
+            """, (habit_id, completed_at, request_key)).rowcount
+            if not inserted:
+                return True  # already recorded under this request_key
+            conn.execute("UPDATE habits SET completed = 1, due_date = ? WHERE id = ?", (new_due_date, habit_id))
+
+            if cached is None or cached["stale"] or cached["last_completed_at"] > completed_at:
+                _rebuild_streaks(conn, [habit_id])
+            else:
+                state = streaks.advance(streaks.bucketing_for(row["periodicity"]), tuple(cached)[:3], completed_at)
+                _store_streak_state(conn, habit_id, state)
+            bump_data_version(conn)
+        return True
 
     def mark_habit_broken(self, habit_id):
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("UPDATE habits SET completed = 2 WHERE id = ?", (habit_id,))
-        conn.commit()
-        conn.close()
+        with transaction(immediate=True, db_name=self.db_name) as conn:
+            conn.execute("UPDATE habits SET completed = 2 WHERE id = ?", (habit_id,))
+            bump_data_version(conn)
 
     def update_habit_statuses(self):
-        conn = get_connection()
-        c = conn.cursor()
+        """
+        Rolls overdue habits over to their next due date: completed habits are
+        reopened, unfinished ones are marked broken. Only habits with
+        due_date < today are read, with their next scheduled day looked up in
+        habit_schedule, and the whole pass is skipped once it has run today
+        (see the 'last_rollover' marker in app_state).
+        """
         today = datetime.now().date()
-        c.execute("SELECT * FROM habits")
-        rows = c.fetchall()
-
-        for row in rows:
-            habit = Habit.from_row(row)
-            if isinstance(habit.active_days, str):
-                try:
-                    active_list = json.loads(habit.active_days)
-                except Exception:
-                    active_list = []
-            else:
-                active_list = habit.active_days or []
-
-            current_due = None
-            if habit.due_date:
-                try:
-                    current_due = datetime.fromisoformat(habit.due_date).date()
-                except Exception:
-                    current_due = None
-
-            if current_due is None or current_due < today:
-                habit_dict = {"periodicity": habit.periodicity, "active_days": active_list}
-                next_due = calculate_next_due_date(habit_dict)
+        marker = today.isoformat()
+        if get_state(get_connection(self.db_name), "last_rollover") == marker:
+            return
+
+        with transaction(immediate=True, db_name=self.db_name) as conn:
+            # another worker may have finished the rollover while we waited for the lock
+            if get_state(conn, "last_rollover") == marker:
+                return
+
+            rows = conn.execute(f"""
+                SELECT id, periodicity, due_date, completed, {_SCHEDULE_ANCHOR} AS anchor FROM habits h
+                WHERE due_date IS NULL OR due_date < :today
+            """, {"today": marker}).fetchall()
+
+            next_due_dates = {}
+            updates = []
+            for row in rows:
+                key = (row["periodicity"], row["anchor"])
+                if key not in next_due_dates:
+                    next_due_dates[key] = _next_due_date(row["periodicity"], row["anchor"], today)
+                next_due = next_due_dates[key]
+
+                current_due = None
+                if row["due_date"]:
+                    try:
+                        current_due = datetime.fromisoformat(row["due_date"]).date()
+                    except Exception:
+                        current_due = None
+
                 if current_due is None:
-                    c.execute("UPDATE habits SET due_date = ? WHERE id = ?", (next_due, habit.id))
+                    completed = row["completed"]
+                elif current_due < today:
+                    completed = 0 if row["completed"] == 1 else 2
                 else:
-                    if habit.completed == 1:
-                        c.execute("UPDATE habits SET completed = 0, due_date = ? WHERE id = ?", (next_due, habit.id))
-                    else:
-                        c.execute("UPDATE habits SET completed = 2, due_date = ? WHERE id = ?", (next_due, habit.id))
+                    continue
+                updates.append((completed, next_due, row["id"]))
 
-        conn.commit()
-        conn.close()
+            if updates:
+                conn.executemany("UPDATE habits SET completed = ?, due_date = ? WHERE id = ?", updates)
+                bump_data_version(conn)
+            set_state(conn, "last_rollover", marker)
 
     # --- Queries ---
-    def get_all_habits(self):
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("SELECT * FROM habits")
-        habits = [Habit.from_row(row) for row in c.fetchall()]
-        conn.close()
-        return habits
+    def get_data_version(self):
+        """Changes whenever habit data is written through this class."""
+        return get_data_version(get_connection(self.db_name))
+
+    def get_all_habits(self, columns=None):
+        """All habits; `columns` limits the selected columns (e.g. Habit.SUMMARY_COLUMNS)."""
+        rows = get_connection(self.db_name).execute(f"SELECT {_column_list(columns)} FROM habits").fetchall()
+        return [Habit.from_row(row) for row in rows]
 
     def get_habit_by_id(self, habit_id):
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("SELECT * FROM habits WHERE id = ?", (habit_id,))
-        row = c.fetchone()
-        conn.close()
+        row = get_connection(self.db_name).execute("SELECT * FROM habits WHERE id = ?", (habit_id,)).fetchone()
         return Habit.from_row(row) if row else None
 
-    def get_habits_by_periodicity(self, periodicity):
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("SELECT * FROM habits WHERE periodicity = ?", (periodicity,))
-        habits = [Habit.from_row(row) for row in c.fetchall()]
-        conn.close()
-        return habits
-
-    def get_completions(self, habit_id):
-        conn = get_connection()
-        c = conn.cursor()
-        c.execute("SELECT completed_at FROM completions WHERE habit_id = ? ORDER BY completed_at", (habit_id,))
-        rows = [r["completed_at"] for r in c.fetchall()]
-        conn.close()
-        return rows
+    def get_habits_by_periodicity(self, periodicity, columns=None):
+        rows = get_connection(self.db_name).execute(
+            f"SELECT {_column_list(columns)} FROM habits WHERE periodicity = ?", (periodicity,)
+        ).fetchall()
+        return [Habit.from_row(row) for row in rows]
+
+    def get_due_habits(self, start, end, columns=None):
+        """
+        Habits due or scheduled between the ISO dates start and end (inclusive),
+        by due date: both come from index range scans, on habits.due_date and
+        on habit_schedule.day.
+        """
+        sql = f"""
+            SELECT {_column_list(columns)} FROM habits WHERE id IN (
+                SELECT habit_id FROM habit_schedule WHERE day BETWEEN :start AND :end
+                UNION
+                SELECT id FROM habits WHERE due_date BETWEEN :start AND :end
+            )
+            ORDER BY due_date, id
+        """
+        rows = get_connection(self.db_name).execute(sql, {"start": start, "end": end}).fetchall()
+        return [Habit.from_row(row) for row in rows]
+
+    def query_habits(self, sort="created", filter=None, periodicity=None, status=None, page=1, page_size=50,
+                     columns=None):
+        """
+        One page of the habit list, filtered and ordered in SQL. sort is a key
+        of HABIT_SORTS, prefixed with "-" for descending order; filter matches
+        names case-insensitively; status is "open", "completed" or "broken".
+        Returns (habits, has_next). Each sort and filter is served by an index
+        on habits, and pages are cut with LIMIT/OFFSET.
+        """
+        descending = sort.startswith("-")
+        order = HABIT_SORTS.get(sort.lstrip("-"))
+        if order is None:
+            raise ValueError(f"unknown sort: {sort}")
+        if page < 1 or page_size < 1:
+            raise ValueError("page and page_size must be positive")
+
+        where, params = [], {"limit": page_size + 1, "offset": (page - 1) * page_size}
+        if filter:
+            where.append("name LIKE :filter ESCAPE '\\'")
+            params["filter"] = "%" + re.sub(r"([\\%_])", r"\\\1", filter) + "%"
+        if periodicity:
+            where.append("periodicity = :periodicity")
+            params["periodicity"] = periodicity
+        if status:
+            codes = {name: code for code, name in Habit.STATUS_NAMES.items()}
+            if status not in codes:
+                raise ValueError(f"unknown status: {status}")
+            where.append("completed = :completed")
+            params["completed"] = codes[status]
+
+        direction = " DESC" if descending else ""
+        sql = f"SELECT {_column_list(columns)} FROM habits"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order}{direction}"
+        if order != "id":
+            sql += f", id{direction}"
+        sql += " LIMIT :limit OFFSET :offset"
+        rows = get_connection(self.db_name).execute(sql, params).fetchall()
+        return [Habit.from_row(row) for row in rows[:page_size]], len(rows) > page_size
+
+    def get_completions(self, habit_id, after=None, limit=None):
+        """Completion timestamps in order; after/limit select one page (see get_completion_page)."""
+        return self.get_completion_page(habit_id, after, limit)[0]
+
+    def get_completion_page(self, habit_id, after=None, limit=None):
+        """
+        One keyset page of completion timestamps, ordered by (completed_at, id)
+        so that rows sharing a timestamp are never skipped. after is the cursor
+        returned with the previous page ("<completed_at>,<id>"). Returns
+        (timestamps, cursor of the next page or None). Raises ValueError for
+        a malformed cursor.
+        """
+        sql = "SELECT id, completed_at FROM completions WHERE habit_id = ?"
+        params = [habit_id]
+        if after is not None:
+            completed_at, _, row_id = after.rpartition(",")
+            sql += " AND (completed_at, id) > (?, ?)"
+            params += [completed_at, int(row_id)]
+        sql += " ORDER BY completed_at, id"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        rows = get_connection(self.db_name).execute(sql, params).fetchall()
+        cursor = f"{rows[-1]['completed_at']},{rows[-1]['id']}" if limit is not None and len(rows) == limit else None
+        return [r["completed_at"] for r in rows], cursor
+
+    def iter_completions(self, habit_id, batch_size=1000):
+        """Yields all completion timestamps in order, fetching one keyset page at a time."""
+        after = None
+        while True:
+            page, after = self.get_completion_page(habit_id, after=after, limit=batch_size)
+            yield from page
+            if after is None:
+                return
 
     # --- Streaks ---
+    # Streaks are served from the habit_streaks cache table. Writes through
+    # this class keep it current; rows flagged stale by the completions
+    # triggers are rebuilt lazily before the next read.
     def get_longest_streak(self, habit_id):
-        completions = self.get_completions(habit_id)
-        if not completions:
-            return 0
-
-        dates = [datetime.fromisoformat(c) for c in completions]
-        dates.sort()
-        habit = self.get_habit_by_id(habit_id)
-        period = habit.periodicity
-
-        longest = current = 1
-        for i in range(1, len(dates)):
-            diff = (dates[i] - dates[i - 1]).days
-            if (period == "daily" and diff == 1) or (period == "weekly" and diff <= 7) \
-               or (period == "monthly" and diff <= 31) or (period == "yearly" and diff <= 366):
-                current += 1
-                longest = max(longest, current)
-            else:
-                current = 1
-        return longest
+        return self.get_streaks([habit_id])[habit_id][1]
 
     def get_longest_streak_overall(self):
-        habits = self.get_all_habits()
-        if not habits:
+        self._refresh_stale_streaks()
+        row = get_connection(self.db_name).execute("""
+            SELECT h.name, s.longest_streak FROM habit_streaks s JOIN habits h ON h.id = s.habit_id
+            WHERE s.longest_streak > 0
+            ORDER BY s.longest_streak DESC, s.habit_id LIMIT 1
+        """).fetchone()
+        if row is None:
             return None, 0
-
-        longest_habit = None
-        longest_streak = 0
-
-        for h in habits:
-            streak = self.get_longest_streak(h.id)
-            if streak > longest_streak:
-                longest_streak = streak
-                longest_habit = h.name
-        return longest_habit, longest_streak
+        return row["name"], row["longest_streak"]
 
     def get_streak(self, habit_id):
         """
         Returns the current streak (consecutive successful periods up to today).
         """
-        completions = self.get_completions(habit_id)
-        if not completions:
-            return 0
-
-        dates = [datetime.fromisoformat(c).date() for c in completions]
-        dates.sort()
-        habit = self.get_habit_by_id(habit_id)
-        period = habit.periodicity
-        today = datetime.now().date()
-
-        current_streak = 1
-        for i in range(len(dates) - 1, 0, -1):
-            diff = (dates[i] - dates[i - 1]).days
+        return self.get_streaks([habit_id])[habit_id][0]
 
-            if (period == "daily" and diff == 1) or \
-               (period == "weekly" and diff <= 7) or \
-               (period == "monthly" and diff <= 31) or \
-               (period == "yearly" and diff <= 366):
-                current_streak += 1
-            else:
-                break
+    def get_streaks(self, habit_ids=None):
+        """
+        Returns {habit_id: (current_streak, longest_streak)} for the given habits
+        (all cached habits if None). Habits without completions map to (0, 0).
+        """
+        self._refresh_stale_streaks()
+        sql = """
+            SELECT s.habit_id, h.periodicity, s.last_completed_at, s.current_run, s.longest_streak
+            FROM habit_streaks s JOIN habits h ON h.id = s.habit_id
+        """
+        if habit_ids is not None:
+            habit_ids = list(habit_ids)
+            if not habit_ids:
+                return {}
+            sql += " WHERE s.habit_id IN (SELECT value FROM json_each(?))"
+            params = (json.dumps(habit_ids),)
+        else:
+            params = ()
 
-        last_completion = dates[-1]
-        if (period == "daily" and (today - last_completion).days > 1) or \
-           (period == "weekly" and (today - last_completion).days > 7) or \
-           (period == "monthly" and (today - last_completion).days > 31) or \
-           (period == "yearly" and (today - last_completion).days > 366):
-            return 0
+        today = datetime.now().date()
+        result = {h_id: (0, 0) for h_id in habit_ids or ()}
+        for row in get_connection(self.db_name).execute(sql, params):
+            current = streaks.current_streak(row["periodicity"], row["last_completed_at"], row["current_run"], today)
+            result[row["habit_id"]] = (current, row["longest_streak"])
+        return result
+
+    def rebuild_streaks(self, habit_ids=None):
+        """Recomputes the streak cache from completions (all habits if None)."""
+        with transaction(immediate=True, db_name=self.db_name) as conn:
+            _rebuild_streaks(conn, habit_ids)
+
+    def _refresh_stale_streaks(self):
+        conn = get_connection(self.db_name)
+        if conn.execute("SELECT 1 FROM habit_streaks WHERE stale = 1 LIMIT 1").fetchone() is None:
+            return
+        with transaction(immediate=True, db_name=self.db_name) as conn:
+            stale = [r["habit_id"] for r in conn.execute("SELECT habit_id FROM habit_streaks WHERE stale = 1")]
+            if stale:
+                _rebuild_streaks(conn, stale)
 
-        return current_streak
+    # --- Compaction ---
+    def compact_completions(self, before, archive=None):
+        """
+        Rolls raw completions dated before `before` (an ISO date) into
+        completion_summaries, one row per habit and day with the day's count
+        and first/last timestamp. Streaks, the heatmap and analytics read the
+        summaries alongside the raw rows, so their results do not change, and
+        exports list each compacted day with its count; get_completions only
+        lists the raw rows that are left.
+        With archive (a file path) the raw rows are copied there first, under
+        the same write lock as the delete, so every compacted row is archived.
+        Returns the number of rows compacted.
+        """
+        cutoff = str(before)[:10]  # whole days only, so a day is never split between summary and raw rows
+        with transaction(immediate=True, db_name=self.db_name) as conn:
+            if archive:
+                # committed before the delete; if this transaction then fails, re-running
+                # archives the same ids again, which changes nothing
+                rows = conn.execute(
+                    "SELECT id, habit_id, completed_at, request_key FROM completions WHERE completed_at < ?", (cutoff,)
+                ).fetchall()
+                archive_completions(archive, [tuple(r) for r in rows])
+            conn.execute("""
+                INSERT INTO completion_summaries (habit_id, day, count, first_completed_at, last_completed_at)
+                SELECT habit_id, substr(completed_at, 1, 10), COUNT(*), MIN(completed_at), MAX(completed_at)
+                FROM completions WHERE completed_at < ? GROUP BY 1, 2
+                ON CONFLICT(habit_id, day) DO UPDATE SET
+                    count = count + excluded.count,
+                    first_completed_at = MIN(first_completed_at, excluded.first_completed_at),
+                    last_completed_at = MAX(last_completed_at, excluded.last_completed_at)
+            """, (cutoff,))
+            compacted = conn.execute("DELETE FROM completions WHERE completed_at < ?", (cutoff,)).rowcount
+            if compacted:
+                # the delete trigger took the rows out of the heatmap and marked their streaks stale
+                conn.execute("""
+                    INSERT INTO completion_days (habit_id, day, count)
+                    SELECT habit_id, day, count FROM completion_summaries WHERE day < ?
+                    ON CONFLICT(habit_id, day) DO UPDATE SET count = excluded.count
+                """, (cutoff,))
+                bump_data_version(conn)
+        return compacted
+
+    # --- Heatmap ---
+    def get_heatmap(self, habit_id=None, start=None, end=None):
+        """
+        Completions per day as {"YYYY-MM-DD": count} for one habit, or summed
+        over all habits if habit_id is None, read from the completion_days
+        aggregate. start/end are inclusive ISO dates.
+        """
+        sql = "SELECT day, SUM(count) AS count FROM completion_days WHERE day BETWEEN ? AND ?"
+        params = [start or "0000-00-00", end or "9999-99-99"]
+        if habit_id is not None:
+            sql += " AND habit_id = ?"
+            params.append(habit_id)
+        sql += " GROUP BY day"
+        return {r["day"]: r["count"] for r in get_connection(self.db_name).execute(sql, params)}
+
+    def rebuild_heatmap(self):
+        """Recomputes the completion_days aggregate from completions and their summaries."""
+        with transaction(immediate=True, db_name=self.db_name) as conn:
+            rebuild_completion_days(conn)
+
+
+def _column_list(columns):
+    """SQL column list for a habits query; only Habit attributes are allowed."""
+    if columns is None:
+        return "*"
+    unknown = set(columns) - set(_HABIT_COLUMNS)
+    if unknown:
+        raise ValueError(f"unknown habit columns: {', '.join(sorted(unknown))}")
+    return ", ".join(columns)
+
+
+# Sort keys of query_habits -> ORDER BY expression; ties are broken by id.
+HABIT_SORTS = {
+    "created": "id",
+    "name": "name COLLATE NOCASE",
+    "periodicity": "periodicity",
+    "due": "due_date",
+    "status": "completed",
+}
+
+_HABIT_COLUMNS = ("id", "name", "periodicity", "created_at", "start_date", "due_date", "active_days", "completed",
+                  "version")
+
+
+# For a habits row aliased h: its first scheduled day from :today on, or else its
+# last one. calculate_next_due_date only ever looks at that one day.
+_SCHEDULE_ANCHOR = """COALESCE(
+    (SELECT MIN(day) FROM habit_schedule s WHERE s.habit_id = h.id AND s.day >= :today),
+    (SELECT MAX(day) FROM habit_schedule s WHERE s.habit_id = h.id))"""
+
+
+def _next_due_date(periodicity, anchor, today):
+    return calculate_next_due_date({"periodicity": periodicity, "active_days": [anchor] if anchor else []}, today)
+
+
+def _store_streak_state(conn, habit_id, state):
+    """Writes a streaks.advance() state. habit_streaks.tail_run is unused since calendar streaks."""
+    last_completed_at, run, longest = state
+    conn.execute("""
+        INSERT INTO habit_streaks (habit_id, last_completed_at, current_run, longest_streak, stale)
+        VALUES (?, ?, ?, ?, 0)
+        ON CONFLICT(habit_id) DO UPDATE SET
+            last_completed_at = excluded.last_completed_at, current_run = excluded.current_run,
+            longest_streak = excluded.longest_streak, stale = 0
+    """, (habit_id, last_completed_at, run, longest))
+
+
+def _rebuild_streaks(conn, habit_ids=None):
+    """Recomputes cache rows from completions and their summaries in one ordered, grouped scan."""
+    sql = f"""
+        SELECT c.habit_id, h.periodicity, c.completed_at
+        FROM ({ALL_COMPLETIONS}) c JOIN habits h ON h.id = c.habit_id
+    """
+    params = ()
+    if habit_ids is None:
+        conn.execute("DELETE FROM habit_streaks")
+    else:
+        habit_ids = json.dumps(list(habit_ids))
+        conn.execute("DELETE FROM habit_streaks WHERE habit_id IN (SELECT value FROM json_each(?))", (habit_ids,))
+        sql += " WHERE c.habit_id IN (SELECT value FROM json_each(?))"
+        params = (habit_ids,)
+    sql += " ORDER BY c.habit_id, c.completed_at"
+
+    # rows arrive ordered by habit, so only one habit's completions are held at a time
+    for habit_id, group in groupby(conn.execute(sql, params), key=lambda r: r["habit_id"]):
+        group = list(group)
+        state = streaks.streak_state(group[0]["periodicity"], (r["completed_at"] for r in group))
+        _store_streak_state(conn, habit_id, state)
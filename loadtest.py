@@ -0,0 +1,155 @@
+# loadtest.py
+"""
+Concurrent load test of the completion write path.
+
+Starts several server processes on one fresh database (like a multi-worker
+deployment) and hammers GET /complete/<id> from many client threads. Every
+keyed request is sent several times, as double clicks and retries would,
+alongside unkeyed ones. Afterwards the database must hold exactly one
+completion per distinct key plus one per unkeyed request, and the streak
+cache must equal a full rebuild:
+
+    python loadtest.py --workers 4 --threads 32 --habits 20 --requests 2000
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import storage
+
+
+def serve(db_name, port, ready):
+    """Worker process: one threaded server on the shared database."""
+    storage.DB_NAME = db_name
+    os.environ["HABIT_TRACKER_SCHEDULER"] = "off"
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)  # no access log
+    from werkzeug.serving import make_server
+    import app as app_module
+    server = make_server("127.0.0.1", port, app_module.app, threaded=True)
+    ready.set()
+    server.serve_forever()
+
+
+def _free_port():
+    import socket
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def plan_requests(habit_ids, requests, duplicates, keyed_share, seed=0):
+    """
+    The URLs to send, shuffled: keyed requests repeated `duplicates` times each,
+    the rest unkeyed. Returns (paths, expected completions per habit).
+    """
+    rng = random.Random(seed)
+    paths, expected = [], Counter()
+    keyed = int(requests * keyed_share) // duplicates
+    for n in range(keyed):
+        habit_id = rng.choice(habit_ids)
+        paths += [f"/complete/{habit_id}?key=load-{n}"] * duplicates
+        expected[habit_id] += 1
+    for _ in range(requests - keyed * duplicates):
+        habit_id = rng.choice(habit_ids)
+        paths.append(f"/complete/{habit_id}")
+        expected[habit_id] += 1
+    rng.shuffle(paths)
+    return paths, expected
+
+
+def run(workers=4, threads=32, habits=20, requests=2000, duplicates=3, keyed_share=0.5, seed=0):
+    """Runs the load test in a temporary directory and returns a report; report["ok"] tells if it passed."""
+    with tempfile.TemporaryDirectory() as tmp:
+        storage.DB_NAME = db_name = os.path.join(tmp, "load.db")
+        from habit_manager import HabitManager
+        manager = HabitManager(db_name)
+        habit_ids = manager.add_habits([(f"load {i}", "daily", []) for i in range(habits)])
+        paths, expected = plan_requests(habit_ids, requests, duplicates, keyed_share, seed)
+
+        ctx = multiprocessing.get_context("spawn")
+        ports, processes = [], []
+        for _ in range(workers):
+            port, ready = _free_port(), ctx.Event()
+            process = ctx.Process(target=serve, args=(db_name, port, ready), daemon=True)
+            process.start()
+            ready.wait(30)
+            ports.append(port)
+            processes.append(process)
+
+        opener = urllib.request.build_opener(_NoRedirect)
+
+        def send(i):
+            url = f"http://127.0.0.1:{ports[i % workers]}{paths[i]}"
+            try:
+                return opener.open(url, timeout=60).status
+            except urllib.error.HTTPError as e:
+                return e.code
+
+        try:
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(threads) as pool:
+                statuses = Counter(pool.map(send, range(len(paths))))
+            elapsed = time.perf_counter() - t0
+        finally:
+            for process in processes:
+                process.terminate()
+                process.join()
+
+        conn = storage.get_connection(db_name)
+        actual = Counter({r["habit_id"]: r["n"] for r in conn.execute(
+            "SELECT habit_id, COUNT(*) AS n FROM completions GROUP BY habit_id")})
+        cached = manager.get_streaks(habit_ids)
+        manager.rebuild_streaks()
+        rebuilt = manager.get_streaks(habit_ids)
+        storage.close_connections()
+
+    mismatches = {h: {"expected": expected[h], "actual": actual[h]} for h in habit_ids if expected[h] != actual[h]}
+    return {
+        "ok": not mismatches and set(statuses) == {302} and cached == rebuilt,
+        "workers": workers,
+        "threads": threads,
+        "requests": len(paths),
+        "duplicates": duplicates,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(paths) / elapsed, 1),
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "completions": sum(actual.values()),
+        "expected_completions": sum(expected.values()),
+        "mismatches": mismatches,
+        "streak_cache_consistent": cached == rebuilt,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Hammer /complete/<id> concurrently and verify the results.")
+    parser.add_argument("--workers", type=int, default=4, help="server processes")
+    parser.add_argument("--threads", type=int, default=32, help="concurrent client threads")
+    parser.add_argument("--habits", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=2000, help="total requests sent")
+    parser.add_argument("--duplicates", type=int, default=3, help="times each keyed request is sent")
+    parser.add_argument("--keyed-share", type=float, default=0.5, help="share of requests carrying a key")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    report = run(args.workers, args.threads, args.habits, args.requests, args.duplicates, args.keyed_share, args.seed)
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+# metrics.py
+"""
+Opt-in request profiling.
+
+enable(app) instruments SQL statements, HabitManager methods and template
+rendering, adds a Server-Timing header to every response and serves
+Prometheus text metrics at /_metrics. Nothing is wrapped until enable()
+is called, so a disabled app runs the plain code paths.
+"""
+import functools
+import threading
+import time
+
+from flask import Response, g, request, template_rendered, before_render_template
+
+import storage
+from habit_manager import HabitManager
+
+_lock = threading.Lock()
+_current = threading.local()  # accumulator of the request running on this thread
+_totals = {}                  # (metric, labels) -> value
+_originals = {}               # HabitManager attributes replaced by enable()
+_enabled_apps = set()
+
+
+class ProfiledConnection(storage.PooledConnection):
+    """Pooled connection that times every statement for the current request."""
+
+    def execute(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(*args, **kwargs)
+        finally:
+            _record("sql", time.perf_counter() - t0)
+
+    def executemany(self, *args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(*args, **kwargs)
+        finally:
+            _record("sql", time.perf_counter() - t0)
+
+
+def _record(key, seconds):
+    acc = getattr(_current, "acc", None)
+    if acc is not None:
+        count, total = acc.get(key, (0, 0.0))
+        acc[key] = (count + 1, total + seconds)
+
+
+def _timed_method(name, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _record(f"hm.{name}", time.perf_counter() - t0)
+    return wrapper
+
+
+def _add(metric, labels, value):
+    key = (metric, labels)
+    _totals[key] = _totals.get(key, 0) + value
+
+
+def _before_request():
+    _current.acc = {}
+    g._metrics_start = time.perf_counter()
+
+
+def _before_render(sender, template, context, **extra):
+    g._metrics_template_start = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    start = g.pop("_metrics_template_start", None)
+    if start is not None:
+        _record(f"tpl.{template.name}", time.perf_counter() - start)
+
+
+def _after_request(response):
+    start = g.pop("_metrics_start", None)
+    acc = getattr(_current, "acc", None)
+    _current.acc = None
+    if start is None or acc is None:
+        return response
+
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or "unknown"
+    sql_count, sql_time = acc.get("sql", (0, 0.0))
+    template_time = sum(t for key, (_, t) in acc.items() if key.startswith("tpl."))
+
+    timings = [f"app;dur={elapsed * 1000:.2f}",
+               f'sql;dur={sql_time * 1000:.2f};desc="{sql_count} statements"',
+               f"tpl;dur={template_time * 1000:.2f}"]
+    for key, (_, seconds) in sorted(acc.items()):
+        if key.startswith("hm."):
+            timings.append(f"{key[3:]};dur={seconds * 1000:.2f}")
+    response.headers["Server-Timing"] = ", ".join(timings)
+
+    with _lock:
+        labels = (("endpoint", endpoint),)
+        _add("habit_tracker_requests_total", labels, 1)
+        _add("habit_tracker_request_seconds_total", labels, elapsed)
+        _add("habit_tracker_sql_statements_total", labels, sql_count)
+        _add("habit_tracker_sql_seconds_total", labels, sql_time)
+        for key, (count, seconds) in acc.items():
+            if key.startswith("hm."):
+                _add("habit_tracker_manager_calls_total", (("method", key[3:]),), count)
+                _add("habit_tracker_manager_seconds_total", (("method", key[3:]),), seconds)
+            elif key.startswith("tpl."):
+                _add("habit_tracker_template_renders_total", (("template", key[4:]),), count)
+                _add("habit_tracker_template_seconds_total", (("template", key[4:]),), seconds)
+    return response
+
+
+def render_prometheus():
+    """All collected totals in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        items = sorted(_totals.items())
+    seen = set()
+    for (metric, labels), value in items:
+        if metric not in seen:
+            seen.add(metric)
+            lines.append(f"# TYPE {metric} counter")
+        label_text = ",".join(f'{k}="{v}"' for k, v in labels)
+        lines.append(f"{metric}{{{label_text}}} {value:g}" if label_text else f"{metric} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_endpoint():
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+def enable(app):
+    """Turns on profiling for app. Call once at startup, before serving requests."""
+    if app in _enabled_apps:
+        return
+    _enabled_apps.add(app)
+
+    if not _originals:
+        for name, attr in list(vars(HabitManager).items()):
+            if callable(attr) and not name.startswith("_"):
+                _originals[name] = attr
+                setattr(HabitManager, name, _timed_method(name, attr))
+        storage.connection_factory = ProfiledConnection
+        storage.close_connections()
+
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    app.add_url_rule("/_metrics", "metrics", metrics_endpoint)
+
+
+def disable():
+    """Restores the uninstrumented HabitManager and connections (request hooks stay registered but idle)."""
+    for name, attr in _originals.items():
+        setattr(HabitManager, name, attr)
+    _originals.clear()
+    storage.connection_factory = storage.PooledConnection
+    storage.close_connections()
@@ -0,0 +1,37 @@
+# page_cache.py
+import threading
+from collections import OrderedDict
+
+
+class PageCache:
+    """
+    Thread-safe, bounded LRU cache for rendered pages.
+    Keys include the data version, so entries never need explicit
+    invalidation: writes simply make old keys unreachable until they are evicted.
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
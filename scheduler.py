@@ -0,0 +1,125 @@
+# scheduler.py
+"""
+Background status rollover.
+
+Runs HabitManager.update_habit_statuses() at local midnight and every
+`interval` seconds, outside the request path. A lease row in app_state
+makes sure only one process does the work when several workers run the
+scheduler; the others skip while it is held. The lease is released as soon
+as the run ends, so its ttl only matters when a worker dies mid-run.
+
+Standalone worker (use with HABIT_TRACKER_SCHEDULER=external for the app):
+
+    python scheduler.py --interval 3600
+"""
+import argparse
+import glob
+import logging
+import os
+import socket
+import threading
+from datetime import datetime, time, timedelta
+
+import storage
+from habit_manager import HabitManager
+
+DEFAULT_INTERVAL = 3600  # seconds between runs besides the one at midnight
+OWNER = f"{socket.gethostname()}:{os.getpid()}"
+
+log = logging.getLogger(__name__)
+
+
+def seconds_until_next_run(interval, now=None):
+    """Seconds until the next local midnight or `interval`, whichever comes first."""
+    now = now or datetime.now()
+    midnight = datetime.combine(now.date() + timedelta(days=1), time.min)
+    return max(0.0, min(float(interval), (midnight - now).total_seconds()))
+
+
+def acquire_lease(db_name=None, ttl=2 * DEFAULT_INTERVAL, owner=OWNER):
+    """
+    Takes or renews the rollover lease of a database for ttl seconds.
+    Returns False while another owner holds an unexpired lease.
+    """
+    now = datetime.now()
+    with storage.transaction(immediate=True, db_name=db_name) as conn:
+        lease = storage.get_state(conn, "rollover_lease")
+        if lease:
+            holder, _, expires = lease.partition("|")
+            if holder != owner and datetime.fromisoformat(expires) > now:
+                return False
+        storage.set_state(conn, "rollover_lease", f"{owner}|{(now + timedelta(seconds=ttl)).isoformat()}")
+    return True
+
+
+def release_lease(db_name=None, owner=OWNER):
+    """Gives up the rollover lease of a database if owner still holds it."""
+    with storage.transaction(immediate=True, db_name=db_name) as conn:
+        lease = storage.get_state(conn, "rollover_lease")
+        if lease and lease.partition("|")[0] == owner:
+            conn.execute("DELETE FROM app_state WHERE key = 'rollover_lease'")
+
+
+def databases():
+    """Every database that needs rollovers: all tenant files in multi-tenant mode."""
+    from tenancy import TENANT_HEADER
+    if TENANT_HEADER:
+        return sorted(glob.glob(os.path.join(storage.TENANT_DIR, "*.db")))
+    return [storage.DB_NAME]
+
+
+def run_rollover(ttl=2 * DEFAULT_INTERVAL):
+    """Rolls over every database this process holds the lease for. Returns those databases."""
+    done = []
+    for db_name in databases():
+        if acquire_lease(db_name, ttl):
+            try:
+                HabitManager(db_name).update_habit_statuses()
+            finally:
+                release_lease(db_name)
+            done.append(db_name)
+    return done
+
+
+class RolloverScheduler(threading.Thread):
+    """Daemon thread running run_rollover() at start, at midnight and every interval."""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        super().__init__(name="rollover-scheduler", daemon=True)
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.is_set():
+            try:
+                run_rollover(ttl=2 * self.interval)
+            except Exception:
+                log.exception("status rollover failed")
+            # one extra second so a wake-up at midnight lands on the new day
+            self._stopped.wait(seconds_until_next_run(self.interval) + 1)
+        storage.close_connections()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the habit status rollover as a standalone worker.")
+    parser.add_argument("--interval", type=int, default=DEFAULT_INTERVAL, help="seconds between runs")
+    parser.add_argument("--once", action="store_true", help="run a single rollover and exit")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.once:
+        log.info("rolled over: %s", ", ".join(run_rollover(ttl=2 * args.interval)) or "nothing (lease held elsewhere)")
+        return
+    scheduler = RolloverScheduler(args.interval)
+    scheduler.start()
+    try:
+        scheduler.join()
+    except KeyboardInterrupt:
+        scheduler.stop()
+
+
+if __name__ == "__main__":
+    main()
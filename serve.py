@@ -0,0 +1,49 @@
+# serve.py
+"""
+Production launcher.
+
+    python serve.py --mode sync --workers 4 --threads 8 --port 8000
+    python serve.py --mode async --workers 4 --port 8000
+
+sync serves the Flask app (app:app) through gunicorn, async the ASGI app
+(asgi:application) through uvicorn; both are in requirements.txt.
+Defaults come from HABIT_TRACKER_WORKERS and HABIT_TRACKER_THREADS.
+
+For development run `flask --app app run --debug` or
+`uvicorn asgi:application --reload` instead.
+"""
+import argparse
+import importlib.util
+import os
+import sys
+
+DEFAULT_WORKERS = int(os.environ.get("HABIT_TRACKER_WORKERS", os.cpu_count() or 1))
+DEFAULT_THREADS = int(os.environ.get("HABIT_TRACKER_THREADS", 8))
+
+
+def _installed(name):
+    return importlib.util.find_spec(name) is not None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve the habit tracker with several worker processes.")
+    parser.add_argument("--mode", choices=("sync", "async"), default="sync")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="worker processes")
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS, help="threads per gunicorn worker")
+    args = parser.parse_args(argv)
+
+    server = "gunicorn" if args.mode == "sync" else "uvicorn"
+    if not _installed(server):
+        parser.error(f"{server} is not installed (pip install -r requirements.txt)")
+    if args.mode == "sync":
+        os.execv(sys.executable, [sys.executable, "-m", "gunicorn", "app:app",
+                                  "--bind", f"{args.host}:{args.port}",
+                                  "--workers", str(args.workers), "--threads", str(args.threads)])
+    import uvicorn
+    uvicorn.run("asgi:application", host=args.host, port=args.port, workers=args.workers)
+
+
+if __name__ == "__main__":
+    main()
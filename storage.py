@@ -1,18 +1,207 @@
 # storage.py
+import os
+import random
+import re
 import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
-DB_NAME = "data/habits.db"
+DB_NAME = os.environ.get("HABIT_TRACKER_DB", "data/habits.db")
+TENANT_DIR = "data/users"    # one database file per user in multi-tenant mode
+MAX_THREAD_CONNECTIONS = 32  # open connections kept per thread across tenant files
+BUSY_TIMEOUT = 2      # seconds SQLite waits for a lock before reporting SQLITE_BUSY
+BUSY_RETRIES = 4      # further attempts to take the write lock after that
+BUSY_BACKOFF = 0.05   # seconds before the first retry, doubled (plus jitter) each time
 
-def get_connection():
-    conn = sqlite3.connect(DB_NAME, timeout=10)
+# Applied once to every new connection.
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",     # ~16 MB page cache
+    "PRAGMA mmap_size = 134217728",   # 128 MB memory-mapped I/O
+    "PRAGMA temp_store = MEMORY",
+)
+
+_local = threading.local()
+
+
+class DatabaseBusyError(sqlite3.OperationalError):
+    """The write lock could not be taken within BUSY_RETRIES attempts."""
+
+
+class PooledConnection(sqlite3.Connection):
+    """
+    A connection that stays open for the lifetime of its thread.
+    close() only rolls back an unfinished transaction so that callers
+    written against plain sqlite3 connections keep working.
+    """
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def really_close(self):
+        super().close()
+
+
+# Class used for new connections; metrics.enable() swaps in a timing subclass.
+connection_factory = PooledConnection
+
+
+def _open(db_name):
+    conn = sqlite3.connect(db_name, timeout=BUSY_TIMEOUT, factory=connection_factory)
     conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    migrate(conn)
     return conn
 
-def init_db():
-    """Creates tables if they do not exist."""
-    conn = get_connection()
-    c = conn.cursor()
 
+def get_connection(db_name=None):
+    """
+    Returns this thread's connection to db_name (default DB_NAME). The first
+    call per thread and file opens it and brings the schema up to date.
+    Reuse only pays off with long-lived threads (a thread pool, gunicorn
+    threads): servers that start a thread per request, like werkzeug's
+    threaded=True, open a new connection (PRAGMAs plus the user_version
+    check) on every request.
+    """
+    db_name = db_name or DB_NAME
+    pool = getattr(_local, "connections", None)
+    if pool is None:
+        pool = _local.connections = OrderedDict()
+    conn = pool.get(db_name)
+    if conn is None:
+        conn = pool[db_name] = _open(db_name)
+        while len(pool) > MAX_THREAD_CONNECTIONS:
+            pool.popitem(last=False)[1].really_close()
+    else:
+        pool.move_to_end(db_name)
+    return conn
+
+
+def close_connections():
+    """Closes all connections held by the current thread."""
+    pool = getattr(_local, "connections", None) or {}
+    for conn in pool.values():
+        conn.really_close()
+    pool.clear()
+
+
+_TENANT_ID = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+
+def tenant_db_path(user_id):
+    """
+    Routes a user id to its own database file under TENANT_DIR, so writes of
+    different users never contend for the same SQLite lock.
+    """
+    user_id = str(user_id)
+    if not _TENANT_ID.match(user_id):
+        raise ValueError(f"invalid user id: {user_id!r}")
+    os.makedirs(TENANT_DIR, exist_ok=True)
+    return os.path.join(TENANT_DIR, f"{user_id}.db")
+
+
+def copy_database(source, target):
+    """
+    Copies one database file into another with SQLite's online backup API
+    (consistent even while the source is in use) and migrates the copy.
+    """
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        src.close()
+        dst.close()
+    migrate(get_connection(target))
+
+
+def _is_busy(error):
+    return getattr(error, "sqlite_errorcode", None) in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+
+
+def _begin(conn, immediate):
+    """
+    Starts a transaction. BEGIN IMMEDIATE is retried with exponential backoff
+    and jitter while another connection holds the write lock; nothing has run
+    yet at that point, so retrying is always safe.
+    """
+    if not immediate:
+        conn.execute("BEGIN")
+        return
+    for attempt in range(BUSY_RETRIES + 1):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if not _is_busy(e):
+                raise
+            if attempt == BUSY_RETRIES:
+                raise DatabaseBusyError(str(e)) from e
+        time.sleep(BUSY_BACKOFF * 2 ** attempt * (1 + random.random()))
+
+
+@contextmanager
+def transaction(immediate=False, db_name=None):
+    """
+    Runs the enclosed block in a single transaction on the thread's connection.
+    Commits on success, rolls back on error. Nested blocks join the outer
+    transaction. immediate=True takes the write lock up front (BEGIN IMMEDIATE),
+    which every read-then-write block should do; DatabaseBusyError is raised
+    if the lock stays taken through all retries.
+    """
+    conn = get_connection(db_name)
+    if conn.in_transaction:
+        yield conn
+        return
+
+    _begin(conn, immediate)
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+
+def get_state(conn, key):
+    """Reads a value from the app_state key/value table (None if unset)."""
+    row = conn.execute("SELECT value FROM app_state WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else None
+
+
+def set_state(conn, key, value):
+    """Writes a value to the app_state key/value table."""
+    conn.execute(
+        "INSERT INTO app_state (key, value) VALUES (?, ?) "
+        "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+        (key, value)
+    )
+
+
+def get_data_version(conn):
+    """Counter bumped by every write to habit data; 0 for a fresh database."""
+    return int(get_state(conn, "data_version") or 0)
+
+
+def bump_data_version(conn):
+    """Increments the data version inside the caller's write transaction."""
+    conn.execute(
+        "INSERT INTO app_state (key, value) VALUES ('data_version', 1) "
+        "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+    )
+
+
+# --- Schema migrations ---
+# Each step upgrades the schema by one version; PRAGMA user_version stores
+# the number of steps already applied. Append new steps, never edit old ones.
+
+def _create_tables(c):
     c.execute('''
         CREATE TABLE IF NOT EXISTS habits (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -35,5 +224,328 @@ def init_db():
         )
     ''')
 
-    conn.commit()
-    conn.close()
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS app_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+    ''')
+
+
+def _index_completions(c):
+    # covers get_completions: filter on habit_id, ordered by completed_at
+    c.execute("CREATE INDEX IF NOT EXISTS idx_completions_habit_completed_at ON completions (habit_id, completed_at)")
+
+
+def _index_habits(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_habits_periodicity ON habits (periodicity)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_habits_due_date ON habits (due_date)")
+
+
+def _create_streak_cache(c):
+    # One row per habit with completions, maintained by HabitManager on write.
+    # Any other change to completions flags the row as stale so it is rebuilt
+    # on the next read.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS habit_streaks (
+            habit_id INTEGER PRIMARY KEY,
+            last_completed_at TEXT,
+            current_run INTEGER NOT NULL DEFAULT 0,
+            tail_run INTEGER NOT NULL DEFAULT 0,
+            longest_streak INTEGER NOT NULL DEFAULT 0,
+            stale INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_habit_streaks_stale ON habit_streaks (habit_id) WHERE stale = 1")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_habit_streaks_longest ON habit_streaks (longest_streak DESC, habit_id)")
+
+    for event, refs in (("INSERT", ("NEW",)), ("DELETE", ("OLD",)), ("UPDATE", ("OLD", "NEW"))):
+        body = "".join(
+            f"INSERT INTO habit_streaks (habit_id, stale) VALUES ({ref}.habit_id, 1) "
+            f"ON CONFLICT(habit_id) DO UPDATE SET stale = 1; "
+            for ref in refs
+        )
+        c.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_completions_{event.lower()}_streaks
+            AFTER {event} ON completions
+            BEGIN {body}END
+        """)
+
+    c.execute("INSERT OR IGNORE INTO habit_streaks (habit_id, stale) SELECT DISTINCT habit_id, 1 FROM completions")
+
+
+def _skip_redundant_stale_marks(c):
+    # Only flag a habit stale if it is not already, so bulk inserts skip the upsert.
+    for event, refs in (("INSERT", ("NEW",)), ("DELETE", ("OLD",)), ("UPDATE", ("OLD", "NEW"))):
+        c.execute(f"DROP TRIGGER IF EXISTS trg_completions_{event.lower()}_streaks")
+        for ref in refs:
+            c.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS trg_completions_{event.lower()}_streaks_{ref.lower()}
+                AFTER {event} ON completions
+                WHEN NOT EXISTS (SELECT 1 FROM habit_streaks WHERE habit_id = {ref}.habit_id AND stale = 1)
+                BEGIN
+                    INSERT INTO habit_streaks (habit_id, stale) VALUES ({ref}.habit_id, 1)
+                    ON CONFLICT(habit_id) DO UPDATE SET stale = 1;
+                END
+            """)
+
+
+def _create_completion_days(c):
+    # Completions per habit and calendar day, kept in step with completions by
+    # triggers so heatmaps read a few hundred aggregate rows instead of raw history.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS completion_days (
+            habit_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (habit_id, day)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_completion_days_day ON completion_days (day)")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_completions_insert_days
+        AFTER INSERT ON completions
+        BEGIN
+            INSERT INTO completion_days (habit_id, day, count) VALUES (NEW.habit_id, substr(NEW.completed_at, 1, 10), 1)
+            ON CONFLICT(habit_id, day) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_completions_delete_days
+        AFTER DELETE ON completions
+        BEGIN
+            UPDATE completion_days SET count = count - 1
+            WHERE habit_id = OLD.habit_id AND day = substr(OLD.completed_at, 1, 10);
+            DELETE FROM completion_days
+            WHERE habit_id = OLD.habit_id AND day = substr(OLD.completed_at, 1, 10) AND count <= 0;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_completions_update_days
+        AFTER UPDATE OF habit_id, completed_at ON completions
+        BEGIN
+            UPDATE completion_days SET count = count - 1
+            WHERE habit_id = OLD.habit_id AND day = substr(OLD.completed_at, 1, 10);
+            DELETE FROM completion_days
+            WHERE habit_id = OLD.habit_id AND day = substr(OLD.completed_at, 1, 10) AND count <= 0;
+            INSERT INTO completion_days (habit_id, day, count) VALUES (NEW.habit_id, substr(NEW.completed_at, 1, 10), 1)
+            ON CONFLICT(habit_id, day) DO UPDATE SET count = count + 1;
+        END
+    ''')
+    c.execute('''
+        INSERT INTO completion_days (habit_id, day, count)
+        SELECT habit_id, substr(completed_at, 1, 10), COUNT(*) FROM completions GROUP BY 1, 2
+    ''')
+
+
+def _rebucket_streaks(c):
+    # streaks are now counted per calendar period (see streaks.py); recompute every cached row
+    c.execute("UPDATE habit_streaks SET stale = 1")
+
+
+def _add_completion_request_keys(c):
+    # Idempotency key of the request that created a completion; a retried or
+    # double-submitted request carries the same key and is written only once.
+    c.execute("ALTER TABLE completions ADD COLUMN request_key TEXT")
+    c.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_completions_request_key
+        ON completions (habit_id, request_key) WHERE request_key IS NOT NULL
+    """)
+
+
+# Rows of a habits.active_days JSON array; invalid JSON reads as no rows.
+_ACTIVE_DAYS = "json_each(CASE WHEN json_valid({ref}.active_days) THEN {ref}.active_days ELSE '[]' END)"
+
+
+def _create_habit_schedule(c):
+    # habits.active_days normalized to one row per habit and scheduled day, so
+    # "what is scheduled between X and Y" is an index range scan. Triggers keep
+    # it in step with the JSON column, whichever code path writes habits.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS habit_schedule (
+            habit_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            PRIMARY KEY (habit_id, day)
+        ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_habit_schedule_day ON habit_schedule (day, habit_id)")
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_habits_insert_schedule
+        AFTER INSERT ON habits
+        BEGIN
+            INSERT OR IGNORE INTO habit_schedule (habit_id, day)
+            SELECT NEW.id, date(value) FROM {_ACTIVE_DAYS.format(ref="NEW")} WHERE date(value) IS NOT NULL;
+        END
+    ''')
+    c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_habits_update_schedule
+        AFTER UPDATE OF id, active_days ON habits
+        BEGIN
+            DELETE FROM habit_schedule WHERE habit_id = OLD.id;
+            INSERT OR IGNORE INTO habit_schedule (habit_id, day)
+            SELECT NEW.id, date(value) FROM {_ACTIVE_DAYS.format(ref="NEW")} WHERE date(value) IS NOT NULL;
+        END
+    ''')
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_habits_delete_schedule
+        AFTER DELETE ON habits
+        BEGIN
+            DELETE FROM habit_schedule WHERE habit_id = OLD.id;
+        END
+    ''')
+    c.execute(f"""
+        INSERT OR IGNORE INTO habit_schedule (habit_id, day)
+        SELECT h.id, date(value) FROM habits h, {_ACTIVE_DAYS.format(ref="h")} WHERE date(value) IS NOT NULL
+    """)
+
+
+def _create_completion_summaries(c):
+    # Compacted history (see HabitManager.compact_completions): one row per
+    # habit and day standing in for that day's raw completions. A day is the
+    # finest streak period, so every periodicity's streaks come out the same.
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS completion_summaries (
+            habit_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            first_completed_at TEXT NOT NULL,
+            last_completed_at TEXT NOT NULL,
+            PRIMARY KEY (habit_id, day)
+        ) WITHOUT ROWID
+    ''')
+
+
+def _add_habit_versions(c):
+    # Per-habit change counter: bumped by every write to a habit or its
+    # completions, so a rendered row keyed by (id, version) stays valid until
+    # that habit changes (see the fragment cache in app.py).
+    c.execute("ALTER TABLE habits ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS trg_habits_update_version
+        AFTER UPDATE ON habits
+        WHEN NEW.version = OLD.version
+        BEGIN
+            UPDATE habits SET version = OLD.version + 1 WHERE id = NEW.id;
+        END
+    ''')
+    for event, ref in (("INSERT", "NEW"), ("DELETE", "OLD"), ("UPDATE", "NEW")):
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_completions_{event.lower()}_version
+            AFTER {event} ON completions
+            BEGIN
+                UPDATE habits SET version = version + 1 WHERE id = {ref}.habit_id;
+            END
+        ''')
+
+
+def _index_habit_list(c):
+    # sorting and filtering of the habit list (HabitManager.query_habits)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_habits_completed ON habits (completed)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_habits_name ON habits (name COLLATE NOCASE)")
+
+
+# Every completion timestamp streaks need: one per compacted day, plus the raw rows.
+ALL_COMPLETIONS = """
+    SELECT habit_id, last_completed_at AS completed_at, count FROM completion_summaries
+    UNION ALL
+    SELECT habit_id, completed_at, 1 FROM completions
+"""
+
+
+def rebuild_completion_days(c):
+    """Recomputes completion_days from completions and their summaries (backfill / repair)."""
+    c.execute("DELETE FROM completion_days")
+    c.execute(f'''
+        INSERT INTO completion_days (habit_id, day, count)
+        SELECT habit_id, substr(completed_at, 1, 10), SUM(count) FROM ({ALL_COMPLETIONS}) GROUP BY 1, 2
+    ''')
+
+
+def archive_completions(archive_path, rows):
+    """
+    Appends (id, habit_id, completed_at, request_key) rows to the completions
+    table of a separate archive file and commits them. Ids are kept, so
+    archiving the same rows again changes nothing.
+    """
+    conn = sqlite3.connect(archive_path, timeout=BUSY_TIMEOUT)
+    try:
+        with conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS completions (
+                    id INTEGER PRIMARY KEY,
+                    habit_id INTEGER NOT NULL,
+                    completed_at TEXT NOT NULL,
+                    request_key TEXT
+                )
+            ''')
+            conn.executemany("INSERT OR IGNORE INTO completions VALUES (?, ?, ?, ?)", rows)
+    finally:
+        conn.close()
+
+
+def vacuum(db_name=None, mode="incremental"):
+    """
+    Returns free pages to the file system after large deletes. "incremental"
+    switches the file to auto_vacuum = INCREMENTAL once (that takes one full
+    VACUUM) and then only frees the pages on the freelist; "full" rewrites
+    the whole file. Must run outside a transaction.
+    """
+    conn = get_connection(db_name)
+    if mode == "full":
+        conn.execute("VACUUM")
+    elif mode == "incremental":
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            conn.execute("PRAGMA incremental_vacuum")
+    else:
+        raise ValueError("mode must be 'incremental' or 'full'")
+
+
+MIGRATIONS = [
+    _create_tables,
+    _index_completions,
+    _index_habits,
+    _create_streak_cache,
+    _skip_redundant_stale_marks,
+    _create_completion_days,
+    _rebucket_streaks,
+    _add_completion_request_keys,
+    _create_habit_schedule,
+    _create_completion_summaries,
+    _add_habit_versions,
+    _index_habit_list,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(conn):
+    """
+    Applies all pending migrations to conn in one transaction.
+    Returns the schema version found before migrating.
+    """
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version >= SCHEMA_VERSION:
+        return version
+
+    _begin(conn, immediate=True)
+    try:
+        # re-read under the write lock in case another process migrated first
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        c = conn.cursor()
+        for step in MIGRATIONS[version:]:
+            step(c)
+        conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+    return version
+
+
+def init_db():
+    """Creates or upgrades the schema of DB_NAME."""
+    migrate(get_connection())
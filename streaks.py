@@ -0,0 +1,138 @@
+# streaks.py
+"""
+Calendar-correct streaks over period buckets.
+
+Every completion is mapped once to the ordinal of the period it falls in
+(day, ISO week, month, year or a custom bucketing). Completions in the same
+period count once, and a streak is a run of consecutive ordinals, so a
+streak is one pass over the sorted completions.
+
+New periodicities plug in through register() or, for "every N days",
+through the "every_<n>_days" naming scheme understood by bucketing_for().
+"""
+import re
+from abc import ABC, abstractmethod
+from datetime import date, datetime
+
+
+class Bucketing(ABC):
+    """Maps dates to integer period ordinals; consecutive periods differ by one."""
+
+    @abstractmethod
+    def ordinal(self, day):
+        """The ordinal of the period containing the date day."""
+
+
+class Daily(Bucketing):
+    def ordinal(self, day):
+        return day.toordinal()
+
+
+class IsoWeek(Bucketing):
+    """ISO weeks, Monday to Sunday."""
+
+    def ordinal(self, day):
+        return (day.toordinal() - 1) // 7  # date(1, 1, 1) is a Monday
+
+
+class YearMonth(Bucketing):
+    def ordinal(self, day):
+        return day.year * 12 + day.month - 1
+
+
+class Year(Bucketing):
+    def ordinal(self, day):
+        return day.year
+
+
+class EveryNDays(Bucketing):
+    """Consecutive n-day intervals counted from anchor."""
+
+    def __init__(self, n, anchor=date(1, 1, 1)):
+        if n < 1:
+            raise ValueError("n must be at least 1")
+        self.n = n
+        self.anchor = anchor.toordinal()
+
+    def ordinal(self, day):
+        return (day.toordinal() - self.anchor) // self.n
+
+
+class Weekdays(Bucketing):
+    """
+    Monday to Friday, one period each. Weekends are not periods of their own:
+    a weekend completion counts for the following Monday, so skipping
+    Saturday and Sunday does not break a streak.
+    """
+
+    def ordinal(self, day):
+        week, weekday = divmod(day.toordinal() - 1, 7)
+        return week * 5 + min(weekday, 5)
+
+
+BUCKETINGS = {
+    "daily": Daily(),
+    "weekly": IsoWeek(),
+    "monthly": YearMonth(),
+    "yearly": Year(),
+    "weekdays": Weekdays(),
+}
+
+_EVERY_N_DAYS = re.compile(r"every_(\d+)_days")
+
+
+def register(periodicity, bucketing):
+    """Makes streaks of habits with this periodicity use bucketing."""
+    BUCKETINGS[periodicity] = bucketing
+
+
+def bucketing_for(periodicity):
+    """The Bucketing of a periodicity. Unknown periodicities count per day."""
+    bucketing = BUCKETINGS.get(periodicity)
+    if bucketing is None:
+        match = _EVERY_N_DAYS.fullmatch(periodicity or "")
+        bucketing = EveryNDays(int(match.group(1))) if match else BUCKETINGS["daily"]
+    return bucketing
+
+
+def advance(bucketing, state, completed_at):
+    """
+    Extends a streak state (last_completed_at, run, longest) with a completion
+    at or after its last one. Returns the new state; None starts a new one.
+    """
+    if state is None:
+        return completed_at, 1, 1
+
+    last_completed_at, run, longest = state
+    step = bucketing.ordinal(_day(completed_at)) - bucketing.ordinal(_day(last_completed_at))
+    if step == 1:
+        run += 1
+    elif step > 1:
+        run = 1
+    return completed_at, run, max(longest, run)
+
+
+def streak_state(periodicity, completions):
+    """Folds sorted completion timestamps into a streak state, or None if there are none."""
+    bucketing = bucketing_for(periodicity)
+    state = None
+    for completed_at in completions:
+        state = advance(bucketing, state, completed_at)
+    return state
+
+
+def current_streak(periodicity, last_completed_at, run, today):
+    """
+    The run that is still alive today: it ends in the current or the previous
+    period, since the current one is not over yet.
+    """
+    if not last_completed_at:
+        return 0
+    bucketing = bucketing_for(periodicity)
+    if bucketing.ordinal(today) - bucketing.ordinal(_day(last_completed_at)) > 1:
+        return 0
+    return run
+
+
+def _day(timestamp):
+    return datetime.fromisoformat(timestamp).date()
@@ -0,0 +1,34 @@
+# tenancy.py
+import os
+
+from flask import abort, g, has_request_context, request
+
+from habit_manager import HabitManager
+
+# Request header carrying the authenticated user id, set by the auth proxy in
+# front of the app. When unset, every request uses the shared storage.DB_NAME.
+TENANT_HEADER = os.environ.get("HABIT_TRACKER_TENANT_HEADER")
+
+_shared_manager = HabitManager()
+
+
+def current_manager():
+    """
+    The HabitManager for the current request: scoped to the user's own
+    database file in multi-tenant mode, otherwise the shared one.
+    Outside of a request (CLI commands, startup) the shared manager is used.
+    """
+    if not TENANT_HEADER or not has_request_context():
+        return _shared_manager
+
+    manager = g.get("habit_manager")
+    if manager is None:
+        user_id = request.headers.get(TENANT_HEADER)
+        if not user_id:
+            abort(401)
+        try:
+            manager = HabitManager.for_tenant(user_id)
+        except ValueError:
+            abort(400)
+        g.habit_manager = manager
+    return manager
@@ -2,13 +2,16 @@
 import pytest
 import os
 import sqlite3
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from habit_manager import HabitManager
 from storage import init_db, get_connection
 from habit import Habit
 
 TEST_DB = "data/test_habits.db"
 
+# keep the app's background rollover thread out of the tests
+os.environ.setdefault("HABIT_TRACKER_SCHEDULER", "off")
+
 @pytest.fixture(scope="module", autouse=True)
 def setup_test_db():
     """Creates a fresh test database for each test run."""
@@ -41,7 +44,9 @@ def setup_test_db():
     conn.commit()
     conn.close()
     yield
-    # Cleanup after tests
+    # Cleanup after tests: close the pooled connection first, so SQLite removes its -wal/-shm files
+    import storage
+    storage.close_connections()
     if os.path.exists(TEST_DB):
         os.remove(TEST_DB)
 
@@ -119,3 +124,906 @@ def test_delete_habit(manager):
     manager.delete_habit(habit_id)
     habits_after = manager.get_all_habits()
     assert len(habits_after) == len(habits_before) - 1
+
+
+def test_connection_is_reused(manager):
+    """Tests that a thread keeps one open connection across calls."""
+    conn = get_connection()
+    conn.close()
+    assert get_connection() is conn
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+
+def test_transaction_rolls_back_on_error(manager):
+    """Tests that a failing transaction leaves no partial writes."""
+    from storage import transaction
+    before = len(manager.get_all_habits())
+    with pytest.raises(RuntimeError):
+        with transaction() as conn:
+            conn.execute(
+                "INSERT INTO habits (name, periodicity, created_at) VALUES (?, ?, ?)",
+                ("Ghost", "daily", datetime.now().isoformat())
+            )
+            raise RuntimeError("boom")
+    assert len(manager.get_all_habits()) == before
+
+
+def test_bulk_streaks_match_per_habit(manager):
+    """Tests that get_streaks returns the same values as the per-habit functions."""
+    manager.add_habit("Walk", "weekly", ["2025-10-22"])
+    habit = manager.get_all_habits()[-1]
+    conn = get_connection()
+    for days_ago in (20, 14, 9, 3, 3):
+        conn.execute(
+            "INSERT INTO completions (habit_id, completed_at) VALUES (?, ?)",
+            (habit.id, (datetime.now() - timedelta(days=days_ago)).isoformat())
+        )
+    conn.commit()
+
+    streaks = manager.get_streaks()
+    for h in manager.get_all_habits():
+        assert streaks.get(h.id, (0, 0)) == (manager.get_streak(h.id), manager.get_longest_streak(h.id))
+    assert manager.get_streaks([]) == {}
+
+
+def test_update_habit_statuses_rolls_over_once_per_day(manager):
+    """Tests that overdue habits roll over and the pass runs only once a day."""
+    init_db()
+    manager.add_habit("Stretch", "daily", ["2025-10-20"])
+    manager.add_habit("Journal", "daily", ["2025-10-20"])
+    stretch, journal = manager.get_all_habits()[-2:]
+    manager.mark_habit_complete(journal.id)
+    yesterday = (datetime.now() - timedelta(days=1)).date().isoformat()
+    conn = get_connection()
+    conn.execute("DELETE FROM app_state WHERE key = 'last_rollover'")
+    conn.execute("UPDATE habits SET due_date = ? WHERE id IN (?, ?)", (yesterday, stretch.id, journal.id))
+    conn.commit()
+
+    manager.update_habit_statuses()
+    today = datetime.now().date().isoformat()
+    assert manager.get_habit_by_id(stretch.id).completed == 2
+    assert manager.get_habit_by_id(journal.id).completed == 0
+    assert manager.get_habit_by_id(stretch.id).due_date == today
+
+    conn.execute("UPDATE habits SET due_date = ? WHERE id = ?", (yesterday, stretch.id))
+    conn.commit()
+    manager.update_habit_statuses()
+    assert manager.get_habit_by_id(stretch.id).due_date == yesterday
+
+
+def test_migrations_upgrade_existing_db(tmp_path, monkeypatch):
+    """Tests that an unversioned database is upgraded in place on first use."""
+    import storage
+    db = str(tmp_path / "old.db")
+    conn = sqlite3.connect(db)
+    conn.execute("CREATE TABLE habits (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL, "
+                 "periodicity TEXT, created_at TEXT NOT NULL, start_date TEXT, due_date TEXT, "
+                 "active_days TEXT, completed INTEGER DEFAULT 0)")
+    conn.execute("CREATE TABLE completions (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                 "habit_id INTEGER NOT NULL, completed_at TEXT NOT NULL)")
+    conn.commit()
+    conn.close()
+
+    monkeypatch.setattr("storage.DB_NAME", db)
+    conn = get_connection()
+    assert conn.execute("PRAGMA user_version").fetchone()[0] == storage.SCHEMA_VERSION
+    plan = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT completed_at FROM completions WHERE habit_id = ? ORDER BY completed_at", (1,)
+    ).fetchall()
+    assert "idx_completions_habit_completed_at" in " ".join(row[-1] for row in plan)
+    assert storage.migrate(conn) == storage.SCHEMA_VERSION
+
+
+def _reference_next_due_date(periodicity, active_days, today):
+    """The original step-by-step algorithm, kept as an oracle for the closed form."""
+    import calendar
+    dates = sorted(datetime.strptime(d, "%Y-%m-%d").date() for d in active_days)
+    future = [d for d in dates if d >= today]
+    if future:
+        return future[0].isoformat()
+    next_date = last = dates[-1]
+    if periodicity == "daily":
+        while next_date < today:
+            next_date += timedelta(days=1)
+    elif periodicity == "weekly":
+        while next_date < today:
+            next_date += timedelta(weeks=1)
+    elif periodicity == "monthly":
+        y, m = last.year, last.month
+        while next_date < today:
+            m += 1
+            if m > 12:
+                m, y = 1, y + 1
+            next_date = datetime(y, m, min(last.day, calendar.monthrange(y, m)[1])).date()
+    else:
+        y = last.year
+        while next_date < today:
+            y += 1
+            try:
+                next_date = datetime(y, last.month, last.day).date()
+            except ValueError:
+                next_date = datetime(y, last.month, min(last.day, 28)).date()
+    return next_date.isoformat()
+
+
+def test_next_due_date_matches_reference():
+    """Property test: the closed-form due date equals the iterative one on random inputs."""
+    import random
+    from datetime import date
+    from utils import calculate_next_due_date
+
+    rng = random.Random(20251020)
+    special = [date(2020, 2, 29), date(2023, 1, 31), date(2024, 8, 31), date(2023, 12, 31), date(2024, 3, 30)]
+    for _ in range(2000):
+        periodicity = rng.choice(["daily", "weekly", "monthly", "yearly"])
+        today = date(2026, 1, 1) + timedelta(days=rng.randrange(1500))
+        days = [rng.choice(special) if rng.random() < 0.3 else today - timedelta(days=rng.randrange(-60, 4000))
+                for _ in range(rng.randrange(1, 5))]
+        active_days = [d.isoformat() for d in days]
+        habit = {"periodicity": periodicity, "active_days": active_days}
+        assert calculate_next_due_date(habit, today) == \
+            _reference_next_due_date(periodicity, active_days, today), (periodicity, active_days, today)
+
+
+def test_streak_cache_tracks_writes(manager):
+    """Tests that the streak cache stays equal to a full rebuild across writes."""
+    manager.add_habit("Floss", "daily", ["2025-10-20"])
+    habit = manager.get_all_habits()[-1]
+    conn = get_connection()
+    for days_ago in (3, 2):
+        conn.execute(
+            "INSERT INTO completions (habit_id, completed_at) VALUES (?, ?)",
+            (habit.id, (datetime.now() - timedelta(days=days_ago)).isoformat())
+        )
+    conn.commit()
+    assert manager.get_longest_streak(habit.id) == 2
+    assert manager.get_streak(habit.id) == 0
+
+    manager.mark_habit_complete(habit.id)
+    cached = manager.get_streaks()
+    assert cached[habit.id] == (1, 2)
+
+    manager.rebuild_streaks()
+    assert manager.get_streaks() == cached
+
+    manager.update_habit(habit.id, "Floss", "weekly", ["2025-10-20"])
+    weeks = len({(date.today() - timedelta(days=d)).isocalendar()[:2] for d in (3, 2, 0)})
+    assert manager.get_streaks([habit.id])[habit.id] == (weeks, weeks)
+
+    manager.delete_habit(habit.id)
+    assert manager.get_streaks([habit.id])[habit.id] == (0, 0)
+
+
+def test_streaks_count_calendar_periods():
+    """Tests that completions are bucketed per period and deduplicated."""
+    import streaks
+    stamps = ["2026-01-05T08:00", "2026-01-05T21:00", "2026-01-06T07:00", "2026-01-11T23:00",
+              "2026-01-12T06:00", "2026-01-26T06:00"]
+    assert streaks.streak_state("daily", stamps)[1:] == (1, 2)
+    assert streaks.streak_state("weekly", stamps)[1:] == (1, 2)  # Jan 11 is a Sunday, Jan 12 a Monday
+    assert streaks.streak_state("monthly", stamps)[1:] == (1, 1)
+    assert streaks.streak_state("weekdays", ["2026-01-08", "2026-01-09", "2026-01-12"])[1:] == (3, 3)
+    assert streaks.streak_state("every_3_days", ["2026-01-02", "2026-01-04", "2026-01-05"]) == \
+        ("2026-01-05", 2, 2)
+    assert streaks.current_streak("weekly", "2026-01-11T23:00", 4, date(2026, 1, 18)) == 4
+    assert streaks.current_streak("weekly", "2026-01-11T23:00", 4, date(2026, 1, 19)) == 0
+    assert streaks.current_streak("weekdays", "2026-01-09", 2, date(2026, 1, 12)) == 2
+
+
+def test_analytics_matches_streak_cache(tmp_path, monkeypatch):
+    """Tests that the vectorized analytics agree with HabitManager's streaks."""
+    import random
+    import analytics
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "analytics.db"))
+    manager = HabitManager()
+    rng = random.Random(7)
+    for i, periodicity in enumerate(["daily", "weekly", "monthly", "yearly"] * 3):
+        manager.add_habit(f"H{i}", periodicity, [])
+    conn = get_connection()
+    now = datetime.now()
+    for habit in manager.get_all_habits():
+        stamps = {now - timedelta(days=rng.randrange(0, 900), hours=rng.randrange(24)) for _ in range(rng.randrange(0, 60))}
+        conn.executemany("INSERT INTO completions (habit_id, completed_at) VALUES (?, ?)",
+                         [(habit.id, s.isoformat()) for s in stamps])
+    conn.commit()
+
+    report = analytics.build_report()
+    streaks = manager.get_streaks(h.id for h in manager.get_all_habits())
+    for row in report["habits"]:
+        assert (row["current_streak"], row["longest_streak"]) == streaks[row["id"]]
+        assert 0 <= row["completion_rate"] <= 1
+    assert (report["longest_habit"], report["longest_streak"]) == manager.get_longest_streak_overall()
+    assert sum(r["completions"] for r in report["by_periodicity"]) == \
+        conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0]
+
+
+def test_page_cache_evicts_least_recently_used():
+    """Tests that the page cache keeps only the most recently used entries."""
+    from page_cache import PageCache
+    cache = PageCache(maxsize=2)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    cache.get("a")
+    cache.set("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A" and cache.get("c") == "C"
+
+
+def test_pages_revalidate_with_etag(tmp_path, monkeypatch):
+    """Tests that cached pages answer 304 until a write bumps the data version."""
+    import app as app_module
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "etag.db"))
+    client = app_module.app.test_client()
+
+    first = client.get("/")
+    etag = first.headers["ETag"]
+    assert client.get("/", headers={"If-None-Match": etag}).status_code == 304
+
+    client.post("/create", data={"name": "Cache", "periodicity": "daily", "selected_dates": ""})
+    second = client.get("/", headers={"If-None-Match": etag})
+    assert second.status_code == 200
+    assert b"Cache" in second.data
+
+
+def test_api_bulk_operations(tmp_path, monkeypatch):
+    """Tests bulk create, complete, list, paginate and delete through /api/v1."""
+    import app as app_module
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "api.db"))
+    client = app_module.app.test_client()
+
+    bad = client.post("/api/v1/habits", json={"habits": [{"name": "X", "periodicity": "hourly"}]})
+    assert bad.status_code == 400
+    bad = client.post("/api/v1/habits", json={"habits": [
+        {"name": "X", "periodicity": "daily", "active_days": [5, "2025-01-01"]}]})
+    assert bad.status_code == 400 and "YYYY-MM-DD" in bad.get_json()["error"]
+
+    created = client.post("/api/v1/habits", json={"habits": [
+        {"name": "A", "periodicity": "daily"},
+        {"name": "B", "periodicity": "weekly", "active_days": ["2025-10-22"]},
+    ]})
+    assert created.status_code == 201
+    ids = created.get_json()["ids"]
+
+    done = client.post("/api/v1/habits/complete", json={"ids": ids + [9999]}).get_json()
+    assert done["completed"] == ids
+    client.post("/api/v1/habits/complete", json={"ids": ids[:1]})
+
+    habits = client.get("/api/v1/habits").get_json()["habits"]
+    assert [h["status"] for h in habits] == ["completed", "completed"]
+    assert habits[1]["current_streak"] == 1
+
+    page = client.get(f"/api/v1/habits/{ids[0]}/completions?limit=1").get_json()
+    assert len(page["completions"]) == 1 and page["next"]
+    rest = client.get(f"/api/v1/habits/{ids[0]}/completions", query_string={"limit": 1, "after": page["next"]})
+    assert len(rest.get_json()["completions"]) == 1
+
+    client.post("/api/v1/habits/delete", json={"ids": ids})
+    assert client.get("/api/v1/habits").get_json()["habits"] == []
+
+
+def test_detail_pages_and_streams_completions(tmp_path, monkeypatch):
+    """Tests keyset pages on /habit/<id> and the streamed CSV export."""
+    import app as app_module
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "detail.db"))
+    monkeypatch.setattr(app_module, "COMPLETIONS_PAGE_SIZE", 2)
+    habit_id = HabitManager().add_habit("Paged", "daily", [])
+    conn = get_connection()
+    stamps = [f"2025-01-0{d}T08:00:00" for d in (1, 2, 2, 3, 3, 3, 4)]  # duplicates straddle page boundaries
+    conn.executemany("INSERT INTO completions (habit_id, completed_at) VALUES (?, ?)",
+                     [(habit_id, s) for s in stamps])
+    conn.commit()
+    client = app_module.app.test_client()
+
+    first = client.get(f"/habit/{habit_id}").get_data(as_text=True)
+    assert stamps[0] in first and stamps[3] not in first
+    cursor = HabitManager().get_completion_page(habit_id, limit=2)[1]
+    second = client.get(f"/habit/{habit_id}", query_string={"after": cursor}).get_data(as_text=True)
+    assert f"<li>{stamps[2]}</li>" in second and f"<li>{stamps[3]}</li>" in second and stamps[0] not in second
+    assert client.get(f"/habit/{habit_id}", query_string={"after": "garbage"}).status_code == 400
+
+    for batch_size in (1, 2, 3, 10):
+        assert list(HabitManager().iter_completions(habit_id, batch_size=batch_size)) == stamps
+    paged, after = [], None
+    while True:
+        page = client.get(f"/api/v1/habits/{habit_id}/completions", query_string={"limit": 1, "after": after}
+                          if after else {"limit": 1}).get_json()
+        paged += page["completions"]
+        if not (after := page["next"]):
+            break
+    assert paged == stamps
+    csv = client.get(f"/habit/{habit_id}/completions.csv").get_data(as_text=True)
+    assert csv.splitlines()[1:] == [f"{habit_id},{s},1" for s in stamps]
+
+
+def test_benchmark_generates_dataset(tmp_path, monkeypatch):
+    """Tests that the benchmark generator writes the requested synthetic data."""
+    import benchmark
+    monkeypatch.setattr("storage.DB_NAME", TEST_DB)
+    completions = benchmark.generate_db(str(tmp_path / "bench.db"), habits=8, years=1, seed=1)
+    conn = get_connection()
+    assert conn.execute("SELECT COUNT(*) FROM habits").fetchone()[0] == 8
+    assert conn.execute("SELECT COUNT(*) FROM completions").fetchone()[0] == completions > 0
+
+
+def test_metrics_report_server_timing(tmp_path, monkeypatch):
+    """Tests that enabled profiling adds Server-Timing and Prometheus metrics."""
+    import app as app_module
+    import metrics
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "metrics.db"))
+    try:
+        client = app_module.create_app({"PROFILE": True}).test_client()
+        timing = client.get("/").headers["Server-Timing"]
+        assert "sql;dur=" in timing and "query_habits;dur=" in timing
+        body = client.get("/_metrics").get_data(as_text=True)
+        assert 'habit_tracker_requests_total{endpoint="views.index"} ' in body
+        assert 'habit_tracker_template_renders_total{template="index.html"} 1' in body
+    finally:
+        metrics.disable()
+
+
+def test_create_app_is_lazy(tmp_path, monkeypatch):
+    """Tests that building an app touches neither the database nor pandas."""
+    import subprocess
+    import sys
+    db = tmp_path / "lazy.db"
+    script = ("import sys, app; app.create_app(); "
+              "assert 'pandas' not in sys.modules and 'analytics' not in sys.modules")
+    env = dict(os.environ, HABIT_TRACKER_DB=str(db))
+    subprocess.run([sys.executable, "-c", script], env=env, check=True, cwd=os.path.dirname(__file__) or ".")
+    assert not db.exists()
+
+    import app as app_module
+    monkeypatch.setattr("storage.DB_NAME", str(db))
+    first, second = app_module.create_app(), app_module.create_app()
+    assert first.extensions["page_cache"] is not second.extensions["page_cache"]
+    assert first.test_client().get("/").status_code == 200
+    assert db.exists()
+
+
+def test_habit_is_slotted_and_decodes_lazily(manager):
+    """Tests the compact Habit record and column-limited listing."""
+    habit = Habit(1, "Lazy", "daily", "2025-10-20", active_days='["2025-10-21"]')
+    assert not hasattr(habit, "__dict__")
+    assert habit._active_days_json == '["2025-10-21"]'
+    assert habit.active_days == ["2025-10-21"]
+    assert habit._active_days_json is None
+
+    listed = manager.get_all_habits(columns=Habit.SUMMARY_COLUMNS)[-1]
+    assert listed.active_days is None and listed.current_streak is None
+    with pytest.raises(ValueError):
+        manager.get_all_habits(columns=("id", "name; DROP TABLE habits"))
+
+
+def test_tenants_get_separate_databases(tmp_path, monkeypatch):
+    """Tests that each user is routed to an own database file."""
+    import app as app_module
+    monkeypatch.setattr("tenancy.TENANT_HEADER", "X-User-Id")
+    monkeypatch.setattr("storage.TENANT_DIR", str(tmp_path / "users"))
+    client = app_module.app.test_client()
+
+    for user in ("alice", "bob"):
+        client.post("/api/v1/habits", json={"habits": [{"name": f"{user}-habit", "periodicity": "daily"}]},
+                    headers={"X-User-Id": user})
+    alice = client.get("/api/v1/habits", headers={"X-User-Id": "alice"}).get_json()["habits"]
+    assert [h["name"] for h in alice] == ["alice-habit"]
+    assert b"bob-habit" in client.get("/", headers={"X-User-Id": "bob"}).data
+    assert b"bob-habit" not in client.get("/", headers={"X-User-Id": "alice"}).data
+    alice_page = client.get("/", headers={"X-User-Id": "alice"})
+    assert "X-User-Id" in alice_page.headers["Vary"] and "private" in alice_page.headers["Cache-Control"]
+    bob_page = client.get("/", headers={"X-User-Id": "bob", "If-None-Match": alice_page.headers["ETag"]})
+    assert bob_page.status_code == 200 and b"bob-habit" in bob_page.data
+    assert client.get("/").status_code == 401
+    assert client.get("/", headers={"X-User-Id": "../etc"}).status_code == 400
+
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "users" / "alice.db"))
+    result = app_module.app.test_cli_runner().invoke(args=["migrate-to-tenant", "carol"])
+    assert result.exit_code == 0, result.output
+    carol = client.get("/api/v1/habits", headers={"X-User-Id": "carol"}).get_json()["habits"]
+    assert [h["name"] for h in carol] == ["alice-habit"]
+
+
+def test_scheduler_lease_and_timing(manager):
+    """Tests the rollover lease and the midnight-aware wait time."""
+    import scheduler
+    get_connection().execute("DELETE FROM app_state WHERE key = 'rollover_lease'")
+    get_connection().commit()
+    assert scheduler.acquire_lease(owner="worker-1", ttl=60)
+    assert not scheduler.acquire_lease(owner="worker-2", ttl=60)
+    assert scheduler.acquire_lease(owner="worker-1", ttl=-1)
+    assert scheduler.acquire_lease(owner="worker-2", ttl=60)
+
+    assert scheduler.seconds_until_next_run(3600, datetime(2025, 1, 1, 23, 59, 30)) == 30
+    assert scheduler.seconds_until_next_run(3600, datetime(2025, 1, 1, 12, 0)) == 3600
+
+
+def test_run_rollover_holds_and_releases_the_lease(manager, monkeypatch):
+    """Tests that run_rollover takes the lease for the run, releases it, and skips databases leased elsewhere."""
+    import scheduler
+    import storage
+    conn = get_connection()
+    held = []
+    monkeypatch.setattr(HabitManager, "update_habit_statuses",
+                        lambda self: held.append(not scheduler.acquire_lease(owner="other-process", ttl=60)))
+
+    def lease():
+        return storage.get_state(get_connection(), "rollover_lease")
+
+    # lease taken for the duration of the run and released afterwards
+    conn.execute("DELETE FROM app_state WHERE key = 'rollover_lease'")
+    conn.commit()
+    assert scheduler.run_rollover() == [storage.DB_NAME]
+    assert held == [True]
+    assert lease() is None
+
+    # a second process holding the lease makes this one skip, and keeps its lease
+    assert scheduler.acquire_lease(owner="other-process", ttl=60)
+    assert scheduler.run_rollover() == []
+    assert held == [True]
+    assert lease().startswith("other-process|")
+
+    # an expired lease is taken over
+    assert scheduler.acquire_lease(owner="other-process", ttl=-1)
+    assert scheduler.run_rollover() == [storage.DB_NAME]
+    assert held == [True, True]
+    assert lease() is None
+
+
+def test_import_export_round_trip(tmp_path, monkeypatch):
+    """Tests streaming export and chunked import of habits and completions."""
+    import io
+    import transfer
+    import app as app_module
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "source.db"))
+    manager = HabitManager()
+    habit_id = manager.add_habit("Export", "weekly", ["2025-10-22"])
+    manager.mark_habit_complete(habit_id)
+    manager.mark_habit_complete(habit_id)
+
+    for fmt in transfer.FORMATS:
+        habits = "".join(transfer.export_habits(fmt))
+        completions = "".join(transfer.export_completions(fmt))
+        target = str(tmp_path / f"target-{fmt}.db")
+        assert transfer.import_habits(io.StringIO(habits), fmt, target, batch_size=1) == 1
+        assert transfer.import_completions(io.StringIO(completions), fmt, target, batch_size=1) == 2
+        assert "".join(transfer.export_completions(fmt, target)) == completions
+        assert HabitManager(target).get_habit_by_id(habit_id).active_days == ["2025-10-22"]
+
+    with pytest.raises(transfer.InvalidRowError, match="line 2"):
+        transfer.import_habits(io.StringIO("name,periodicity\nBad,hourly\n"), "csv")
+    with pytest.raises(transfer.InvalidRowError, match="YYYY-MM-DD"):
+        transfer.import_habits(io.StringIO('{"name": "Bad", "periodicity": "daily", "active_days": ["x", 5]}\n'), "jsonl")
+    with pytest.raises(transfer.InvalidRowError, match="created_at"):
+        transfer.import_habits(io.StringIO("name,periodicity,created_at\nBad,daily,2025-01-02T10:00:00+02:00\n"), "csv")
+    with pytest.raises(transfer.InvalidRowError, match="due_date"):
+        transfer.import_habits(io.StringIO("name,periodicity,due_date\nBad,daily,20250102\n"), "csv")
+    with pytest.raises(transfer.InvalidRowError, match="completed"):
+        transfer.import_habits(io.StringIO("name,periodicity,completed\nBad,daily,7\n"), "csv")
+    for completed_at in ("2025-01-02T10:00:00+02:00", "20250102"):
+        with pytest.raises(transfer.InvalidRowError, match="completed_at"):
+            transfer.import_completions(io.StringIO(f"habit_id,completed_at\n{habit_id},{completed_at}\n"), "csv")
+    transfer.import_completions(io.StringIO(f"habit_id,completed_at\n{habit_id},2025-01-02 10:00\n"), "csv")
+    assert "2025-01-02T10:00:00" in manager.get_completions(habit_id)
+
+    client = app_module.app.test_client()
+    exported = client.get("/api/v1/export/habits.jsonl").get_data(as_text=True)
+    assert '"name": "Export"' in exported
+    response = client.post("/api/v1/import/completions.csv", data=f"habit_id,completed_at\n{habit_id},2025-01-01T10:00:00\n")
+    assert response.get_json() == {"imported": 1}
+    assert client.post("/api/v1/import/completions.csv", data="habit_id,completed_at\n999,2025-01-01\n").status_code == 400
+    duplicate = client.post("/api/v1/import/habits.jsonl", data=f'{{"id": {habit_id}, "name": "Again", "periodicity": "daily"}}\n')
+    assert duplicate.status_code == 400 and "UNIQUE" in duplicate.get_json()["error"]
+    (tmp_path / "dup.jsonl").write_text(f'{{"id": {habit_id}, "name": "Again", "periodicity": "daily"}}\n')
+    result = app_module.app.test_cli_runner().invoke(
+        args=["import-data", "habits", str(tmp_path / "dup.jsonl"), "--format", "jsonl"])
+    assert result.exit_code == 1 and "UNIQUE" in result.output and isinstance(result.exception, SystemExit)
+
+
+def test_heatmap_aggregate_follows_completions(tmp_path, monkeypatch):
+    """Tests the per-day completion aggregate and the heatmap views."""
+    import app as app_module
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "heatmap.db"))
+    manager = HabitManager()
+    first = manager.add_habit("Heat", "daily", [])
+    second = manager.add_habit("Map", "daily", [])
+    manager.mark_habit_complete(first)
+    manager.mark_habit_complete(first)
+    manager.mark_habit_complete(second)
+    today = date.today().isoformat()
+
+    assert manager.get_heatmap(first) == {today: 2}
+    assert manager.get_heatmap() == {today: 3}
+    manager.delete_habit(second)
+    assert manager.get_heatmap() == {today: 2}
+
+    get_connection().execute("DELETE FROM completion_days")
+    get_connection().commit()
+    manager.rebuild_heatmap()
+    assert manager.get_heatmap(first, start=today, end=today) == {today: 2}
+
+    client = app_module.app.test_client()
+    assert client.get(f"/api/v1/habits/{first}/heatmap").get_json() == {"days": {today: 2}}
+    assert f'title="{today}: 2"'.encode() in client.get(f"/habit/{first}").data
+    assert b'class="heatmap"' in client.get("/analysis").data
+
+
+def test_completions_are_idempotent_per_request_key(tmp_path, monkeypatch):
+    """Tests that repeated keyed completions are recorded once, also across threads."""
+    from concurrent.futures import ThreadPoolExecutor
+    import app as app_module
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "idempotent.db"))
+    manager = HabitManager()
+    habit_id = manager.add_habit("Once", "daily", [])
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(lambda i: manager.mark_habit_complete(habit_id, f"key-{i % 3}"), range(24)))
+    assert all(results)
+    assert len(manager.get_completions(habit_id)) == 3
+    assert manager.mark_habit_complete(habit_id) and len(manager.get_completions(habit_id)) == 4
+
+    client = app_module.app.test_client()
+    page = client.get("/").get_data(as_text=True)
+    key = f"v{manager.get_habit_by_id(habit_id).version}"
+    assert f"/complete/{habit_id}?key={key}" in page
+    client.get(f"/complete/{habit_id}?key={key}")
+    client.get(f"/complete/{habit_id}?key={key}")
+    headers = {"Idempotency-Key": "retry-1"}
+    client.post("/api/v1/habits/complete", json={"ids": [habit_id]}, headers=headers)
+    client.post("/api/v1/habits/complete", json={"ids": [habit_id]}, headers=headers)
+    assert len(manager.get_completions(habit_id)) == 6
+    assert manager.get_streaks([habit_id])[habit_id] == (1, 1)
+
+
+def test_busy_database_is_retried_then_reported(tmp_path, monkeypatch):
+    """Tests the bounded retry on a held write lock and the 503 it ends in."""
+    import sqlite3
+    import app as app_module
+    import storage
+    db = str(tmp_path / "busy.db")
+    monkeypatch.setattr("storage.DB_NAME", db)
+    monkeypatch.setattr("storage.BUSY_TIMEOUT", 0.01)
+    monkeypatch.setattr("storage.BUSY_RETRIES", 2)
+    monkeypatch.setattr("storage.BUSY_BACKOFF", 0.001)
+    manager = HabitManager()
+    habit_id = manager.add_habit("Locked", "daily", [])
+
+    other = sqlite3.connect(db, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    try:
+        with pytest.raises(storage.DatabaseBusyError):
+            manager.mark_habit_complete(habit_id)
+        client = app_module.app.test_client()
+        response = client.get(f"/complete/{habit_id}")
+        assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+        assert client.post("/api/v1/habits/complete", json={"ids": [habit_id]}).status_code == 503
+    finally:
+        other.rollback()
+        other.close()
+    assert manager.mark_habit_complete(habit_id)
+    assert len(manager.get_completions(habit_id)) == 1
+
+
+def test_habit_schedule_drives_due_view_and_rollover(tmp_path, monkeypatch):
+    """Tests the normalized schedule table, the due view and schedule-based rollovers."""
+    import app as app_module
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "schedule.db"))
+    manager = HabitManager()
+    today = date.today()
+    week_end = today + timedelta(days=6 - today.weekday())
+    now_id = manager.add_habit("Now", "weekly", [today.isoformat(), "2020-01-01", "bad"])
+    later_id = manager.add_habit("Later", "monthly", [(today + timedelta(days=40)).isoformat()])
+    conn = get_connection()
+    schedule = lambda: [tuple(r) for r in conn.execute("SELECT habit_id, day FROM habit_schedule ORDER BY habit_id, day")]
+    assert schedule() == [(now_id, "2020-01-01"), (now_id, today.isoformat()),
+                          (later_id, (today + timedelta(days=40)).isoformat())]
+
+    assert [h.name for h in manager.get_due_habits(today.isoformat(), today.isoformat())] == ["Now"]
+    manager.update_habit(later_id, "Later", "monthly", [week_end.isoformat()])
+    assert schedule()[-1] == (later_id, week_end.isoformat())
+    assert {h.name for h in manager.get_due_habits(today.isoformat(), week_end.isoformat())} == {"Now", "Later"}
+
+    client = app_module.app.test_client()
+    assert b"Now" in client.get("/due").data
+    assert b"Later" in client.get("/due?span=week").data
+
+    conn.execute("UPDATE habits SET due_date = '2020-01-01', completed = 1")
+    conn.execute("DELETE FROM app_state WHERE key = 'last_rollover'")
+    conn.commit()
+    manager.update_habit_statuses()
+    assert manager.get_habit_by_id(now_id).due_date == today.isoformat()
+    assert manager.get_habit_by_id(later_id).due_date == week_end.isoformat()
+
+    manager.delete_habit(now_id)
+    assert [h for h, _ in schedule()] == [later_id]
+
+
+def test_asgi_application_serves_dashboard_and_flask_routes(tmp_path, monkeypatch):
+    """Tests the async facade, the native async dashboard and the WSGI bridge."""
+    import asyncio
+    import json
+    import app as app_module
+    import asgi
+    import storage
+    from async_manager import AsyncHabitManager
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "asgi.db"))
+    manager = HabitManager()
+    habit_id = manager.add_habit("Async", "daily", [date.today().isoformat()])
+    manager.mark_habit_complete(habit_id)
+
+    received, started = [], []
+
+    async def request(application, method, path, query=b"", body=b""):
+        messages = []
+        chunks = list(body) if isinstance(body, list) else [body]
+
+        async def receive():
+            received.append(path)
+            chunk = chunks.pop(0)
+            return {"type": "http.request", "body": chunk, "more_body": bool(chunks)}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "query_string": query, "headers": [],
+                 "http_version": "1.1", "scheme": "http", "server": ("test", 80), "client": ("127.0.0.1", 1)}
+        await application(scope, receive, send)
+        started.append(messages[0])
+        status = messages[0]["status"]
+        return status, b"".join(m.get("body", b"") for m in messages[1:])
+
+    async def scenario():
+        habits, streaks = await asyncio.gather(AsyncHabitManager().get_all_habits(), AsyncHabitManager().get_streaks())
+        assert [h.id for h in habits] == [habit_id] and streaks[habit_id] == (1, 1)
+
+        application = asgi.Application(app_module.app)
+        status, body = await request(application, "GET", "/api/v1/dashboard")
+        expected = app_module.app.test_client().get("/api/v1/dashboard").get_json()
+        assert status == 200 and json.loads(body) == expected
+        assert expected["due_today"] == [habit_id] and expected["habits"][0]["current_streak"] == 1
+
+        status, body = await request(application, "GET", "/habit/%d/completions.csv" % habit_id)
+        assert status == 200 and body.startswith(b"habit_id,completed_at,count\r\n%d," % habit_id)
+        status, _ = await request(application, "GET", "/habit/999")
+        assert status == 404
+        assert received == []  # the body is only read when the app asks for it
+
+        # a body arriving in several messages is streamed into the import
+        lines = [b"habit_id,completed_at\n", b"%d,2025-01-01T10:00:00\n%d," % (habit_id, habit_id), b"2025-01-02T10:00:00\n"]
+        status, body = await request(application, "POST", "/api/v1/import/completions.csv", body=lines)
+        assert status == 200 and json.loads(body) == {"imported": 2}
+        assert received.count("/api/v1/import/completions.csv") == 3
+        status, body = await request(application, "POST", "/api/v1/habits/complete", body=json.dumps({"ids": [habit_id]}).encode())
+        assert status == 400  # no JSON content type
+
+        def busy(*args):
+            raise storage.DatabaseBusyError("database is locked")
+
+        monkeypatch.setattr(HabitManager, "get_streaks", busy)
+        status, body = await request(application, "GET", "/api/v1/dashboard")
+        assert status == 503 and json.loads(body) == {"error": "database is busy, retry later"}
+        assert (b"retry-after", b"1") in started[-1]["headers"]
+        application.fallback.close()
+
+    asyncio.run(scenario())
+
+
+def test_asgi_lifespan_starts_and_stops_the_rollover_scheduler(manager, monkeypatch):
+    """Tests that the ASGI lifespan protocol runs the rollover scheduler without waiting for a request."""
+    import asyncio
+    import threading
+    import app as app_module
+    import asgi
+    import scheduler
+    ran = threading.Event()
+    monkeypatch.setattr(scheduler, "run_rollover", lambda ttl: ran.set())
+    flask_app = app_module.create_app({"SCHEDULER": "thread"})
+    application = asgi.Application(flask_app)
+
+    async def scenario():
+        incoming = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message["type"])
+
+        lifespan = asyncio.create_task(application({"type": "lifespan"}, incoming.get, send))
+        await incoming.put({"type": "lifespan.startup"})
+        while not sent:
+            await asyncio.sleep(0.01)
+        assert sent == ["lifespan.startup.complete"]
+        rollover_scheduler = flask_app.extensions["rollover_scheduler"]
+        assert rollover_scheduler.is_alive()
+        assert await asyncio.to_thread(ran.wait, 5)
+
+        await incoming.put({"type": "lifespan.shutdown"})
+        await lifespan
+        assert sent == ["lifespan.startup.complete", "lifespan.shutdown.complete"]
+        assert not rollover_scheduler.is_alive() and flask_app.extensions["rollover_scheduler"] is None
+
+    asyncio.run(scenario())
+
+
+def test_compaction_keeps_streaks_heatmap_and_analytics(tmp_path, monkeypatch):
+    """Tests that compacting old completions changes no derived result and archives the raw rows."""
+    import app as app_module
+    import random
+    import analytics
+    import storage
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "compact.db"))
+    manager = HabitManager()
+    rng = random.Random(3)
+    for i, periodicity in enumerate(["daily", "weekly", "monthly", "yearly"] * 2):
+        manager.add_habit(f"C{i}", periodicity, [])
+    conn = get_connection()
+    now = datetime.now()
+    for habit in manager.get_all_habits():
+        stamps = [now - timedelta(days=rng.randrange(0, 400), hours=rng.randrange(24)) for _ in range(80)]
+        conn.executemany("INSERT INTO completions (habit_id, completed_at) VALUES (?, ?)",
+                         [(habit.id, s.isoformat()) for s in stamps])
+    conn.commit()
+
+    def results():
+        habits = analytics.build_report()["habits"]
+        return manager.get_streaks(), manager.get_heatmap(), [(r["id"], r["completions"]) for r in habits]
+
+    before = results()
+    cutoff = date.today() - timedelta(days=90)
+    old = conn.execute("SELECT COUNT(*) FROM completions WHERE completed_at < ?", (cutoff.isoformat(),)).fetchone()[0]
+    archive = str(tmp_path / "archive.db")
+
+    archive_completions = storage.archive_completions
+
+    def archive_while_writers_wait(path, rows):
+        # a writer adding old history mid-compaction must wait for the lock, not slip between archive and delete
+        other = sqlite3.connect(storage.DB_NAME, timeout=0)
+        with pytest.raises(sqlite3.OperationalError, match="locked"):
+            other.execute("INSERT INTO completions (habit_id, completed_at) VALUES (1, '2000-01-01T00:00:00')")
+        other.close()
+        archive_completions(path, rows)
+
+    monkeypatch.setattr("habit_manager.archive_completions", archive_while_writers_wait)
+    assert manager.compact_completions(cutoff, archive) == old > 0
+    assert conn.execute("SELECT COUNT(*) FROM completions WHERE completed_at < ?", (cutoff.isoformat(),)).fetchone()[0] == 0
+    assert sqlite3.connect(archive).execute("SELECT COUNT(*) FROM completions").fetchone()[0] == old
+    assert results() == before
+    manager.rebuild_streaks()
+    manager.rebuild_heatmap()
+    assert results() == before
+
+    assert manager.compact_completions(cutoff, archive) == 0
+
+    # a backup made after compaction restores the same streaks and heatmap
+    import io
+    import transfer
+    for fmt in transfer.FORMATS:
+        target = str(tmp_path / f"restored-{fmt}.db")
+        transfer.import_habits(io.StringIO("".join(transfer.export_habits(fmt))), fmt, target)
+        exported = "".join(transfer.export_completions(fmt))
+        transfer.import_completions(io.StringIO(exported), fmt, target, batch_size=50)
+        restored = HabitManager(target)
+        assert restored.get_streaks() == before[0] and restored.get_heatmap() == before[1]
+        assert [(r["id"], r["completions"]) for r in analytics.build_report(storage.get_connection(target))["habits"]] \
+            == before[2]
+    habit_id = next(iter(before[0]))
+    csv_rows = app_module.app.test_client().get(f"/habit/{habit_id}/completions.csv").get_data(as_text=True).splitlines()[1:]
+    assert sum(int(row.rsplit(",", 1)[1]) for row in csv_rows) == dict(before[2])[habit_id]
+    storage.vacuum(mode="incremental")
+    assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+    storage.vacuum(mode="incremental")
+    assert results() == before
+
+
+def test_rows_are_cached_per_habit_version_and_responses_compressed(tmp_path, monkeypatch):
+    """Tests fragment caching by habit version, gzip responses and hashed static URLs."""
+    import gzip
+    import app as app_module
+    import assets
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "assets.db"))
+    manager = HabitManager()
+    first, second = manager.add_habits([("Row A", "daily", []), ("Row B", "daily", [])])
+    flask_app = app_module.create_app({"JINJA_CACHE_DIR": str(tmp_path)})
+    client = flask_app.test_client()
+    fragments = flask_app.extensions["fragment_cache"]
+
+    page = client.get("/")
+    assert page.headers.get("Content-Encoding") is None and len(fragments) == 2
+    versions = {h.id: h.version for h in manager.get_all_habits()}
+    manager.mark_habit_complete(first)
+    assert manager.get_habit_by_id(first).version > versions[first]
+    assert manager.get_habit_by_id(second).version == versions[second]
+    assert f"key=v{manager.get_habit_by_id(first).version}" in client.get("/").get_data(as_text=True)
+    assert len(fragments) == 3  # only the changed row was rendered again
+    assert list(tmp_path.glob("__jinja2_*"))
+
+    zipped = client.get("/", headers={"Accept-Encoding": "gzip"})
+    assert zipped.headers["Content-Encoding"] == "gzip" and "Accept-Encoding" in zipped.headers["Vary"]
+    assert b"Row A" in gzip.decompress(zipped.data)
+    assert zipped.headers["ETag"].startswith("W/")
+    assert client.get("/", headers={"Accept-Encoding": "gzip", "If-None-Match": zipped.headers["ETag"]}).status_code == 304
+
+    css = f"/static/style.css?v={assets.static_hash('style.css', flask_app)}"
+    assert css in page.get_data(as_text=True)
+    static = client.get(css, headers={"Accept-Encoding": "gzip"})
+    assert "immutable" in static.headers["Cache-Control"] and "max-age=31536000" in static.headers["Cache-Control"]
+    assert gzip.decompress(static.data) == open(os.path.join(flask_app.static_folder, "style.css"), "rb").read()
+    assert "immutable" not in client.get("/static/style.css?v=stale").headers["Cache-Control"]
+
+
+def test_habit_list_is_sorted_filtered_and_paged_in_sql(tmp_path, monkeypatch):
+    """Tests query_habits and the matching query parameters of the index page."""
+    import app as app_module
+    monkeypatch.setattr("storage.DB_NAME", str(tmp_path / "query.db"))
+    manager = HabitManager()
+    ids = manager.add_habits([(f"{name} {i}", periodicity, [])
+                              for i in range(5) for name, periodicity in (("Run", "daily"), ("Read_", "weekly"))])
+    manager.mark_habit_complete(ids[0])
+    manager.mark_habit_broken(ids[1])
+
+    habits, has_next = manager.query_habits(page_size=4)
+    assert [h.id for h in habits] == ids[:4] and has_next
+    habits, has_next = manager.query_habits(page=3, page_size=4)
+    assert [h.id for h in habits] == ids[8:] and not has_next
+    assert [h.name for h in manager.query_habits(sort="-name", page_size=2)[0]] == ["Run 4", "Run 3"]
+    assert {h.id for h in manager.query_habits(periodicity="weekly")[0]} == set(ids[1::2])
+    assert [h.id for h in manager.query_habits(status="completed")[0]] == [ids[0]]
+    assert [h.id for h in manager.query_habits(sort="status", page_size=2)[0]] == [ids[2], ids[3]]
+    assert len(manager.query_habits(filter="read_")[0]) == 5
+    assert manager.query_habits(filter="%")[0] == []
+    with pytest.raises(ValueError):
+        manager.query_habits(sort="streak")
+
+    plan = get_connection().execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM habits WHERE completed = 0 ORDER BY due_date, id").fetchall()
+    assert any("idx_habits_" in row["detail"] for row in plan)
+
+    client = app_module.app.test_client()
+    page = client.get("/?periodicity=daily&sort=-name").get_data(as_text=True)
+    assert page.index("Run 4") < page.index("Run 0") and "Read_" not in page
+    assert "sort=name" in page  # the active column links to the opposite direction
+    assert client.get("/?sort=bogus").status_code == 400
+
+
+def test_wsgi_bridge_stops_streaming_when_the_client_disconnects():
+    """Tests that a failing send closes the WSGI response and frees the worker thread."""
+    import asyncio
+    import threading
+    import asgi
+    closed = threading.Event()
+
+    def wsgi_app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+
+        def body():
+            try:
+                for _ in range(1000):
+                    yield b"x" * 100
+            finally:
+                closed.set()
+        return body()
+
+    async def scenario():
+        bridge = asgi.WsgiBridge(wsgi_app, threads=1)
+        sent = []
+
+        async def receive():
+            return {"type": "http.request", "body": b"", "more_body": False}
+
+        async def send(message):
+            if len(sent) == 3:
+                raise ConnectionResetError("client went away")
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/", "query_string": b"", "headers": []}
+        for _ in range(3):  # more aborted requests than the bridge has threads
+            closed.clear()
+            sent.clear()
+            with pytest.raises(ConnectionResetError):
+                await bridge(scope, receive, send)
+            assert await asyncio.to_thread(closed.wait, 5)
+        return bridge
+
+    bridge = asyncio.run(scenario())
+    stopper = threading.Thread(target=bridge.close)
+    stopper.start()
+    stopper.join(5)
+    assert not stopper.is_alive()
+
@@ -0,0 +1,246 @@
+# transfer.py
+"""
+Streaming import and export of habits and completions as CSV or JSONL.
+
+Exports iterate the database cursor in batches and yield one chunk of
+lines per batch; imports read one row at a time and write with executemany in
+chunked transactions, so memory use stays constant for any file size.
+
+Completion exports include compacted days (see
+HabitManager.compact_completions) as single rows with a count, so exporting
+and importing again reproduces streaks and heatmaps.
+"""
+import csv
+import io
+import json
+import sqlite3
+from datetime import datetime
+from itertools import islice
+
+from storage import bump_data_version, get_connection, transaction
+from utils import PERIODICITIES, calculate_next_due_date, is_date_list
+
+FORMATS = ("csv", "jsonl")
+HABIT_FIELDS = ("id", "name", "periodicity", "created_at", "start_date", "due_date", "active_days", "completed")
+COMPLETION_FIELDS = ("habit_id", "completed_at", "count")
+BATCH_SIZE = 5000
+
+
+class InvalidRowError(ValueError):
+    """A row in an import file is invalid. Rows before it have been imported."""
+
+
+def _check_format(fmt):
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+
+
+def _export(queries, fields, fmt, db_name, encode_row):
+    """Yields the results of the (sql, params) queries one batch of lines at a time."""
+    _check_format(fmt)
+    conn = get_connection(db_name)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    if fmt == "csv":
+        writer.writerow(fields)
+    for sql, params in queries:
+        cursor = conn.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                record = encode_row(row, fmt)
+                if fmt == "csv":
+                    writer.writerow([record[f] for f in fields])
+                else:
+                    buf.write(json.dumps(record) + "\n")
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def export_habits(fmt, db_name=None):
+    """Yields all habits as lines of CSV (active_days as JSON text) or JSONL."""
+    def encode(row, fmt):
+        record = dict(row)
+        if fmt == "jsonl":
+            record["active_days"] = json.loads(record["active_days"] or "[]")
+        return record
+    sql = f"SELECT {', '.join(HABIT_FIELDS)} FROM habits ORDER BY id"
+    return _export([(sql, ())], HABIT_FIELDS, fmt, db_name, encode)
+
+
+def export_completions(fmt, db_name=None, habit_id=None):
+    """
+    Yields all completions (or those of habit_id) as lines of CSV or JSONL,
+    grouped by habit. Compacted days come first, as one row each whose count
+    is the number of completions it stands for, stamped with the day's last
+    one; raw completions have count 1.
+    """
+    where, params = ("WHERE habit_id = ?", (habit_id,)) if habit_id is not None else ("", ())
+    queries = [
+        (f"""SELECT habit_id, last_completed_at AS completed_at, count FROM completion_summaries {where}
+             ORDER BY habit_id, day""", params),
+        (f"SELECT habit_id, completed_at, 1 AS count FROM completions {where} ORDER BY habit_id, completed_at", params),
+    ]
+    return _export(queries, COMPLETION_FIELDS, fmt, db_name, lambda row, fmt: dict(row))
+
+
+def _read_records(lines, fmt):
+    """Yields (line number, dict) from an iterable of text lines."""
+    _check_format(fmt)
+    if fmt == "csv":
+        reader = csv.DictReader(lines)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for number, line in enumerate(lines, start=1):
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError as e:
+                    raise InvalidRowError(f"line {number}: invalid JSON ({e})")
+
+
+def _iso_timestamp(value, field):
+    """
+    Parses a YYYY-MM-DD date or a naive ISO timestamp and returns it in
+    canonical form; raises ValueError for anything else, including time zone
+    offsets and the basic format (20250102), which fromisoformat accepts.
+    """
+    value = str(value)
+    try:
+        parsed = datetime.fromisoformat(value) if value[4:5] == "-" and value[7:8] == "-" else None
+    except ValueError:
+        parsed = None
+    if parsed is None or parsed.tzinfo is not None:
+        raise ValueError(f"'{field}' must be a YYYY-MM-DD date or an ISO timestamp without a time zone")
+    return parsed.date().isoformat() if len(value) == 10 else parsed.isoformat()
+
+
+def _optional_timestamp(record, field):
+    value = record.get(field)
+    return _iso_timestamp(value, field) if value not in (None, "") else None
+
+
+def _habit_row(record):
+    name = record.get("name")
+    if not name:
+        raise ValueError("'name' is required")
+    periodicity = record.get("periodicity")
+    if periodicity not in PERIODICITIES:
+        raise ValueError(f"'periodicity' must be one of {', '.join(PERIODICITIES)}")
+    active_days = record.get("active_days") or []
+    if isinstance(active_days, str):
+        active_days = json.loads(active_days)
+    if not is_date_list(active_days):
+        raise ValueError("'active_days' must be a list of YYYY-MM-DD dates")
+    due_date = _optional_timestamp(record, "due_date") or calculate_next_due_date(
+        {"periodicity": periodicity, "active_days": active_days})
+    completed = int(record.get("completed") or 0)
+    if completed not in (0, 1, 2):
+        raise ValueError("'completed' must be 0, 1 or 2")
+    return (
+        int(record["id"]) if record.get("id") not in (None, "") else None,
+        name,
+        periodicity,
+        _optional_timestamp(record, "created_at") or datetime.now().isoformat(),
+        _optional_timestamp(record, "start_date"),
+        due_date,
+        json.dumps(active_days),
+        completed,
+    )
+
+
+def _completion_row(habit_ids):
+    def to_row(record):
+        habit_id = int(record["habit_id"])
+        if habit_id not in habit_ids:
+            raise ValueError(f"unknown habit_id {habit_id}")
+        completed_at = _iso_timestamp(record.get("completed_at") or "", "completed_at")
+        count = int(record.get("count") or 1)  # files from before compaction have no count
+        if count < 1:
+            raise ValueError("'count' must be at least 1")
+        return habit_id, completed_at, count
+    return to_row
+
+
+def _import(lines, fmt, to_row, write, db_name, batch_size, in_transaction=None):
+    rows = _validated(_read_records(lines, fmt), to_row)
+    total = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return total
+        try:
+            with transaction(immediate=True, db_name=db_name) as conn:
+                write(conn, [row for _, row in batch])
+                bump_data_version(conn)
+                if in_transaction:
+                    in_transaction(conn)
+        except sqlite3.IntegrityError as e:  # e.g. an id that already exists; the batch is rolled back
+            raise InvalidRowError(f"lines {batch[0][0]}-{batch[-1][0]}: {e}") from e
+        total += len(batch)
+
+
+def _validated(records, to_row):
+    """Yields (line number, row) for each record, raising InvalidRowError for the first bad one."""
+    for number, record in records:
+        try:
+            yield number, to_row(record)
+        except (KeyError, TypeError, ValueError) as e:
+            raise InvalidRowError(f"line {number}: {e}") from e
+
+
+def import_habits(lines, fmt, db_name=None, batch_size=BATCH_SIZE):
+    """
+    Imports habits from an iterable of CSV or JSONL lines and returns how
+    many were written. Rows keep their id if the file has one.
+    """
+    def reset_rollover(conn):
+        # imported habits may already be overdue; let the next rollover see them
+        conn.execute("DELETE FROM app_state WHERE key = 'last_rollover'")
+
+    sql = f"INSERT INTO habits ({', '.join(HABIT_FIELDS)}) VALUES ({', '.join('?' * len(HABIT_FIELDS))})"
+    return _import(lines, fmt, _habit_row, lambda conn, rows: conn.executemany(sql, rows), db_name, batch_size,
+                   reset_rollover)
+
+
+def import_completions(lines, fmt, db_name=None, batch_size=BATCH_SIZE):
+    """
+    Imports completions from an iterable of CSV or JSONL lines; returns how
+    many rows were written. Rows with a count above 1 (compacted days from
+    export_completions) are merged into completion_summaries.
+    """
+    habit_ids = {r["id"] for r in get_connection(db_name).execute("SELECT id FROM habits")}
+    return _import(lines, fmt, _completion_row(habit_ids), _write_completions, db_name, batch_size)
+
+
+def _write_completions(conn, rows):
+    conn.executemany("INSERT INTO completions (habit_id, completed_at) VALUES (?, ?)",
+                     [(habit_id, completed_at) for habit_id, completed_at, count in rows if count == 1])
+    summaries = [(habit_id, completed_at[:10], count, completed_at)
+                 for habit_id, completed_at, count in rows if count > 1]
+    if not summaries:
+        return
+    # what the completions triggers do for raw rows: heatmap counts, stale streaks, habit versions
+    conn.executemany("""
+        INSERT INTO completion_summaries (habit_id, day, count, first_completed_at, last_completed_at)
+        VALUES (?1, ?2, ?3, ?4, ?4)
+        ON CONFLICT(habit_id, day) DO UPDATE SET
+            count = count + excluded.count,
+            first_completed_at = MIN(first_completed_at, excluded.first_completed_at),
+            last_completed_at = MAX(last_completed_at, excluded.last_completed_at)
+    """, summaries)
+    conn.executemany("""
+        INSERT INTO completion_days (habit_id, day, count) VALUES (?1, ?2, ?3)
+        ON CONFLICT(habit_id, day) DO UPDATE SET count = count + excluded.count
+    """, [s[:3] for s in summaries])
+    habit_ids = [(habit_id,) for habit_id in {s[0] for s in summaries}]
+    conn.executemany("""
+        INSERT INTO habit_streaks (habit_id, stale) VALUES (?, 1) ON CONFLICT(habit_id) DO UPDATE SET stale = 1
+    """, habit_ids)
+    conn.executemany("UPDATE habits SET version = version + 1 WHERE id = ?", habit_ids)
@@ -1,38 +1,83 @@
 # utils.py
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
+from bisect import bisect_left
+from functools import lru_cache
 import calendar
 
-def _to_date_list(active_days):
-    """Converts active_days (JSON list or list of strings) to date objects."""
+# Allowed values of habits.periodicity (mirrors the CHECK constraint in storage).
+PERIODICITIES = ("daily", "weekly", "monthly", "yearly")
+
+
+def is_date_list(values):
+    """True if values is a list of YYYY-MM-DD strings (the format of habits.active_days)."""
+    if not isinstance(values, list):
+        return False
+    for value in values:
+        if not isinstance(value, str) or len(value) != 10:
+            return False
+        try:
+            date.fromisoformat(value)
+        except ValueError:
+            return False
+    return True
+
+
+@lru_cache(maxsize=4096)
+def _parse_dates(active_days):
+    """Parses and sorts a tuple of active days once; results are cached."""
     out = []
-    for d in active_days or []:
+    for d in active_days:
         if isinstance(d, str):
+            try:
+                if len(d) == 10 and d[4] == "-" and d[7] == "-":
+                    out.append(date.fromisoformat(d))
+                    continue
+            except ValueError:
+                pass
             try:
                 out.append(datetime.strptime(d, "%Y-%m-%d").date())
             except Exception:
                 continue
         else:
             out.append(d)  # if already a date
-    return sorted(out)
+    return tuple(sorted(out))
+
+def _to_date_list(active_days):
+    """Converts active_days (JSON list or list of strings) to date objects."""
+    return list(_parse_dates(tuple(active_days or ())))
+
+def _add_months(d, months):
+    """Shifts d by whole months, clamping the day to the target month's length."""
+    y, m = divmod(d.year * 12 + d.month - 1 + months, 12)
+    m += 1
+    return date(y, m, min(d.day, calendar.monthrange(y, m)[1]))
+
+def _in_year(d, year):
+    """d moved to another year; Feb 29 becomes Feb 28 outside leap years."""
+    try:
+        return d.replace(year=year)
+    except ValueError:
+        return date(year, d.month, min(d.day, 28))
 
-def calculate_next_due_date(habit):
+def calculate_next_due_date(habit, today=None):
     """
     habit: dict with keys:
       - 'periodicity': 'daily'|'weekly'|'monthly'|'yearly'
       - 'active_days': list of 'YYYY-MM-DD' strings (from calendar), or [].
+    today: reference date, defaults to the current date.
     Returns ISO date (YYYY-MM-DD) for the next due date (>= today),
     or None if not computable.
     """
-    today = datetime.now().date()
+    today = today or datetime.now().date()
     periodicity = (habit.get("periodicity") or "daily")
     active_days = habit.get("active_days") or []
 
-    dates = _to_date_list(active_days)
+    dates = _parse_dates(tuple(active_days))
 
     # 1) if concrete future dates exist -> return earliest >= today
-    future = [d for d in dates if d >= today]
-    if future:
-        return future[0].isoformat()
+    i = bisect_left(dates, today)
+    if i < len(dates):
+        return dates[i].isoformat()
 
     # 2) otherwise: calculate next date based on periodicity
     # if no concrete active_days -> fallback per periodicity
@@ -54,44 +99,53 @@ def calculate_next_due_date(habit):
             except Exception:
                 return datetime(today.year + 1, today.month, today.day).date().isoformat()
 
-    # 3) only past concrete dates exist -> extend last entry periodically until >= today
+    # 3) only past concrete dates exist -> first repetition of the last entry that is >= today
     last = dates[-1]
-    next_date = last
 
     if periodicity == "daily":
-        while next_date < today:
-            next_date = next_date + timedelta(days=1)
-        return next_date.isoformat()
+        return today.isoformat()
 
     if periodicity == "weekly":
-        while next_date < today:
-            next_date = next_date + timedelta(weeks=1)
-        return next_date.isoformat()
+        weeks = -(-(today - last).days // 7)
+        return (last + timedelta(weeks=weeks)).isoformat()
 
     if periodicity == "monthly":
-        y, m = last.year, last.month
-        day = last.day
-        while next_date < today:
-            m += 1
-            if m > 12:
-                m = 1
-                y += 1
-            last_day = calendar.monthrange(y, m)[1]
-            d = min(day, last_day)
-            next_date = datetime(y, m, d).date()
+        months = max((today.year - last.year) * 12 + today.month - last.month, 1)
+        next_date = _add_months(last, months)
+        if next_date < today:
+            next_date = _add_months(last, months + 1)
         return next_date.isoformat()
 
     if periodicity == "yearly":
-        y = last.year
-        month = last.month
-        day = last.day
-        while next_date < today:
-            y += 1
-            try:
-                next_date = datetime(y, month, day).date()
-            except ValueError:
-                next_date = datetime(y, month, min(day, 28)).date()
+        year = max(today.year, last.year + 1)
+        next_date = _in_year(last, year)
+        if next_date < today:
+            next_date = _in_year(last, year + 1)
         return next_date.isoformat()
 
     # fallback
     return today.isoformat()
+
+def heatmap_grid(counts, end=None, weeks=53):
+    """
+    Lays out {"YYYY-MM-DD": count} as a GitHub-style grid ending at `end`
+    (default today): a list of week columns, each a list of up to seven
+    (iso_day, count, level) tuples from Monday to Sunday. level is 0-4,
+    scaled to the busiest day in counts.
+    """
+    end = end or datetime.now().date()
+    start = end - timedelta(days=end.weekday() + 7 * (weeks - 1))
+    busiest = max(counts.values(), default=0)
+    grid = []
+    day = start
+    while day <= end:
+        week = []
+        for _ in range(7):
+            if day > end:
+                break
+            count = counts.get(day.isoformat(), 0)
+            level = -(-4 * count // busiest) if count else 0  # ceil(4 * count / busiest)
+            week.append((day.isoformat(), count, level))
+            day += timedelta(days=1)
+        grid.append(week)
+    return grid